@@ -12,20 +12,171 @@
 #------------------------------------------------------------
 
 
-## TODO : maybe to make some lazy_property's not so lazy to save some memory
 import numpy as np
 import lazy_property
-#import billiard as multiprocessing 
-import  multiprocessing 
-from .__system import System
+import hashlib
+import threading
+from collections import OrderedDict
+from .__system import System, PRECISIONS
+from .__pool import get_pool
+from .__cache import CachedProperty,get_cache
 from .__utility import  print_my_name_start,print_my_name_end,einsumk, FFT_R_to_k, alpha_A,beta_A
 
-def _rotate_matrix(X):
-    return X[1].T.conj().dot(X[0]).dot(X[1])
+class FFTPlanCache():
+    """ LRU cache of the FFT_R_to_k objects (and thus of their FFT plans) of the process, 
+        keyed by the R-vectors (hashed), NKFFT, num_wann, number of threads and the library. 
+        The plans for the different trailing shapes and dtypes are kept inside FFT_R_to_k"""
+
+    def __init__(self,maxsize=16):
+        self.maxsize=maxsize
+        self._cache=OrderedDict()
+        self._lock=threading.Lock()
+        self.hits=0
+        self.misses=0
+
+    def get(self,iRvec,NKFFT,num_wann,numthreads=1,lib='fftw'):
+        iRvec=np.ascontiguousarray(iRvec,dtype=int)
+        key=(hashlib.sha1(iRvec.tobytes()).hexdigest(),iRvec.shape,tuple(int(n) for n in NKFFT),int(num_wann),int(numthreads),lib)
+        with self._lock:
+            if key in self._cache:
+                self.hits+=1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            self.misses+=1
+        fft=FFT_R_to_k(iRvec,NKFFT,num_wann,numthreads=numthreads,lib=lib)
+        with self._lock:
+            self._cache[key]=fft
+            while len(self._cache)>self.maxsize:
+                self._cache.popitem(last=False)
+        return fft
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits=0
+            self.misses=0
+
+    def __str__(self):
+        return "FFT plan cache : {} entries (max {}), {} hits, {} misses".format(len(self._cache),self.maxsize,self.hits,self.misses)
+
+
+fft_plan_cache=FFTPlanCache()
+
+
+# bound for the size of the buffer used by Data_K._rotate
+ROTATE_CHUNK_BYTES=2**26
+
+
+class DegenBlocks():
+    """ the groups of degenerate states at all k-points, in CSR form : the groups at k-point ik are 
+        the bands start[i]:end[i] for i in offset[ik]:offset[ik+1]. Indexing by ik (and iteration) gives 
+        the list of tuples (ib1,ib2) of this k-point, so it may be used as the list of lists it replaces"""
+
+    def __init__(self,start,end,offset,num_bands):
+        self.start=start
+        self.end=end
+        self.offset=offset
+        self.num_bands=num_bands
+
+    @classmethod
+    def from_energies(cls,E_K,degen_thresh):
+        """ groups the bands separated by gaps not larger than degen_thresh"""
+        NK,nb=E_K.shape
+        is_start=np.ones((NK,nb),dtype=bool)
+        is_start[:,1:]=(E_K[:,1:]-E_K[:,:-1])>degen_thresh
+        start=np.nonzero(is_start)[1]
+        offset=np.zeros(NK+1,dtype=int)
+        np.cumsum(is_start.sum(axis=1),out=offset[1:])
+        end=np.empty_like(start)
+        end[:-1]=start[1:]
+        end[offset[1:]-1]=nb
+        return cls(start,end,offset,nb)
+
+    @property
+    def NK(self):
+        return len(self.offset)-1
+
+    @property
+    def size(self):
+        return self.end-self.start
+
+    @property
+    def ik(self):
+        "the k-point of every group"
+        return np.repeat(np.arange(self.NK),np.diff(self.offset))
+
+    @property
+    def nbytes(self):
+        return self.start.nbytes+self.end.nbytes+self.offset.nbytes
+
+    def __len__(self):
+        return self.NK
+
+    @lazy_property.LazyProperty
+    def _lists(self):
+        "the lists of tuples (ib1,ib2) of all k-points, built once"
+        groups=list(zip(self.start.tolist(),self.end.tolist()))
+        return [groups[i1:i2] for i1,i2 in zip(self.offset[:-1].tolist(),self.offset[1:].tolist())]
+
+    def __getitem__(self,ik):
+        if isinstance(ik,slice):
+            return self._lists[ik]
+        if ik<-self.NK or ik>=self.NK:
+            raise IndexError("k-point index {} out of range for {} k-points".format(ik,self.NK))
+        return self._lists[ik]
+
+    def __iter__(self):
+        return iter(self._lists)
+
+    def select(self,mask):
+        "only the groups where mask (over all groups) is True"
+        offset=np.zeros(self.NK+1,dtype=int)
+        np.cumsum(np.bincount(self.ik[mask],minlength=self.NK),out=offset[1:])
+        return DegenBlocks(self.start[mask],self.end[mask],offset,self.num_bands)
+
+    def block_sum(self,X):
+        """ X[k,n,...] summed over the bands of each group : array [group,...]"""
+        if len(self.start)==0:
+            return np.zeros((0,)+X.shape[2:],dtype=X.dtype)
+        X=X.reshape((-1,)+X.shape[2:])
+        # reduceat over the pairs (start,end) of the flattened (k,band) index: the even entries are the sums
+        # over start:end, the odd ones (end:next start) are dropped. If the last end is the end of X it is omitted
+        base=self.ik*self.num_bands
+        ind=np.stack((base+self.start,base+self.end),axis=1).reshape(-1)
+        if ind[-1]==X.shape[0]:
+            ind=ind[:-1]
+        return np.add.reduceat(X,ind,axis=0)[::2]
+
+    def block_mean(self,X):
+        """ X[k,n,...] averaged over the bands of each group : array [group,...]"""
+        return self.block_sum(X)/self.size.reshape((-1,)+(1,)*(X.ndim-2))
+
+    def split(self,X):
+        """ splits an array over all groups [group,...] into the list of arrays for each k-point"""
+        return np.split(X,self.offset[1:-1])
+
+    def diagonal_blocks(self,X):
+        """ the diagonal blocks X[k,ib1:ib2,ib1:ib2,...] of all groups, as a list (over k) of lists.
+            The blocks of equal size are extracted at once by fancy indexing"""
+        blocks=[None]*len(self.start)
+        ik=self.ik
+        size=self.size
+        for s in np.unique(size):
+            sel=np.nonzero(size==s)[0]
+            ib=self.start[sel][:,None]+np.arange(s)[None,:]
+            stacked=X[ik[sel][:,None,None],ib[:,:,None],ib[:,None,:]]
+            for i,b in zip(sel.tolist(),stacked):
+                blocks[i]=b
+        return [blocks[i1:i2] for i1,i2 in zip(self.offset[:-1].tolist(),self.offset[1:].tolist())]
+
 
-   
 class Data_K(System):
-    def __init__(self,system,dK=None,NKFFT=None,Kpoint=None,npar=0,fftlib='fftw'):
+    # never evicted from the cache
+    cache_pinned=('E_K','UU_K')
+    # shared intermediates, evicted last and only when all their consumers are evaluated
+    cache_keep=('gdD','gdAbar','gdBbar','gdBbarplus','D_H','V_H')
+
+    def __init__(self,system,dK=None,NKFFT=None,Kpoint=None,npar=0,fftlib='fftw',precision=None,kbatch=None,kchunk=None,cache_limit=None):
 #        self.spinors=system.spinors
         self.iRvec=system.iRvec
         self.real_lattice=system.real_lattice
@@ -36,15 +187,19 @@ class Data_K(System):
         self.frozen_max=system.frozen_max
         self.random_gauge=system.random_gauge
         self.degen_thresh=system.degen_thresh
-        ## TODO : create the plans externally, one per process 
-        self.fft_R_to_k=FFT_R_to_k(system.iRvec,NKFFT,self.num_wann,numthreads=npar if npar>0 else 1,lib=fftlib)
-
-        try:
-            self.poolmap=multiprocessing.Pool(npar).map
-#            print ('created a pool of {} workers'.format(npar))
-        except Exception as err:
-#            print ('failed to create a pool of {} workers : {}'.format(npar,err))
-            self.poolmap=lambda fun,lst : [fun(x) for x in lst]
+        # k-space quantities are evaluated in this precision, the eigenproblem is solved in double precision
+        self.set_precision(getattr(system,'precision','double') if precision is None else precision)
+        # the plans are created once per process and reused (see FFTPlanCache)
+        self.fft_R_to_k=fft_plan_cache.get(system.iRvec,self.NKFFT,self.num_wann,numthreads=npar if npar>0 else 1,lib=fftlib)
+
+        self.npar=npar
+        # number of k-points diagonalized by one call of eigh and rotated at once by _rotate (all if None)
+        self.kbatch=kbatch
+        # if set, the quantities are evaluated by k_chunks() over slices of kchunk k-points 
+        self.kchunk=kchunk
+        # memory limit (bytes) for the evaluated quantities, see __cache.py
+        self.cache_limit=cache_limit
+        self._kslice=slice(None)
         if dK is not None:
             expdK=np.exp(2j*np.pi*system.iRvec.dot(dK))
             self.dK=dK
@@ -52,32 +207,77 @@ class Data_K(System):
             expdK=np.ones(self.nRvec)
             self.dK=np.zeros(3)
  
-        self.HH_R=system.HH_R[:,:,:]*expdK[None,None,:]
-        
+        # the matrices of the system are referenced (not copied) at first access (see System.__getattr__),
+        # the phase expdK is applied when they are staged for the Fourier transform in _R_to_k_H
+        self._system=system
+        self._expdK=expdK
+        self._lazy_R={'HH_R':('system',None)}
         for X in ['AA','BB','CC','SS','SA','SHA']:
             XR=X+'_R'
             hasXR='has_'+X+'_R'
-            vars(self)[XR]=None
-            vars(self)[hasXR]=False
-            if XR in vars(system):
-              if vars(system)[XR] is not  None:
-                if X in ['SA','SHA']:
-                  vars(self)[XR]=vars(system)[XR]*expdK[None,None,:,None,None]
-                else:
-                  vars(self)[XR]=vars(system)[XR]*expdK[None,None,:,None]
-                vars(self)[hasXR]=True
-
-
-    def _rotate(self,mat):
+            vars(self)[hasXR]=system.has_R(XR)
+            if vars(self)[hasXR]:
+                self._lazy_R[XR]=('system',None)
+            else:
+                vars(self)[XR]=None
+        # the attributes copied to the chunks, see k_chunks()
+        self._init_keys=set(vars(self).keys())
+
+    def k_chunks(self):
+        """ yields views of this Data_K restricted to consecutive slices of kchunk k-points (or just self, 
+            if kchunk is None). The chunks share the R-space data and the FFT plans, but all k-space quantities 
+            are evaluated only for the slice (the FFT itself still runs on the full grid). For a chunk 
+            NKFFT_tot is the number of its k-points, so a k-average over the full grid is the sum of 
+            the averages over the chunks weighted by chunk.NKFFT_tot/self.NKFFT_tot"""
+        NK=int(np.prod(self.NKFFT))
+        if self.kchunk is None or self.kchunk>=NK:
+            yield self
+            return
+        for ik in range(0,NK,self.kchunk):
+            chunk=Data_K.__new__(type(self))
+            vars(chunk).update({k:v for k,v in vars(self).items() if k in self._init_keys or k in self._lazy_R})
+            chunk._kslice=slice(ik,min(ik+self.kchunk,NK))
+            yield chunk
+
+    def cache_report(self):
+        "hits, misses and evictions of the cache of the evaluated quantities"
+        return str(get_cache(self))
+
+    def _fft(self,XX_R,hermitian=True):
+        """ the FFT to the full grid, restricted to the k-points of this chunk (copied, 
+            so that the full-grid result is not kept alive by the cached quantities of the chunk)"""
+        XX_K=self.fft_R_to_k( XX_R,hermitian=hermitian)
+        if self._kslice!=slice(None):
+            XX_K=XX_K[self._kslice].copy()
+        return XX_K
+
+    def _load_R(self,name,kind,arg):
+        if kind=='system':
+            return getattr(self._system,name)
+        return super()._load_R(name,kind,arg)
+
+
+    def _rotate(self,mat,kchunk=None):
+        """ rotates mat[k,m,n,...] to the Hamiltonian gauge, U^+ X U , for all k-points and all trailing 
+            components at once, by stacked matmuls on a contiguous buffer of kchunk k-points 
+            (by default kbatch, or as many as fit into ROTATE_CHUNK_BYTES). The result is written into mat"""
         print_my_name_start()
-#        return  np.einsum('kml,kmn,knp->klp',self.UU_K.conj(),mat,self.UU_K)
         assert mat.ndim>2
-        if mat.ndim==3:
-            return  np.array(self.poolmap( _rotate_matrix , zip(mat,self.UU_K)))
-        else:
-            for i in range(mat.shape[-1]):
-                mat[...,i]=self._rotate(mat[...,i])
-            return mat
+        shape=mat.shape
+        NK,nw=shape[:2]
+        X=mat.reshape(NK,nw,nw,-1)
+        if kchunk is None:
+            kchunk=self.kbatch if self.kbatch is not None else ROTATE_CHUNK_BYTES//max(1,X[0].nbytes)
+        kchunk=max(1,kchunk)
+        UU=self.UU_K
+        for ik in range(0,NK,kchunk):
+            sl=slice(ik,min(ik+kchunk,NK))
+            U=UU[sl,None]
+            buf=np.ascontiguousarray(X[sl].transpose(0,3,1,2))
+            tmp=np.matmul(U.conj().swapaxes(-1,-2),buf)
+            np.matmul(tmp,U,out=buf)
+            X[sl]=buf.transpose(0,2,3,1)
+        return X.reshape(shape)
 
     def _R_to_k_H(self,XX_R,der=0,hermitian=True,asym_before=False,asym_after=False):
         """ converts from real-space matrix elements in Wannier gauge to 
@@ -86,21 +286,51 @@ class Data_K(System):
             hermitian [=True] - consoder the matrix hermitian
             asym_before = True -  takes the antisymmetrc part over the first two cartesian indices before differentiation
             asym_after = True  - asymmetrize after  differentiation
-            WARNING: the input matrix is destroyed, use np.copy to preserve it"""
-
-        def asymmetrize(X,asym):
-            """auxilary function"""
-            if asym  :
-                assert len(X.shape)>=5 , "cannot antisymmetrize less then 2 indices"
-                return X[:,:,:,alpha_A,beta_A]-X[:,:,:,beta_A,alpha_A]
-            else:
-                return X
-
-        XX_R=asymmetrize(XX_R, asym_before)
+            the input matrix (normally shared with the System) is not modified.
+            With derivatives or antisymmetrization the transform is fused : each requested cartesian component 
+            is staged in R-space separately (phase, R-weights and signs applied at once) and Fourier transformed, 
+            so the R-space derivative tensor is never formed, and components equal by symmetry 
+            of the derivative indices are transformed only once"""
+
+        if der==0 and not (asym_before or asym_after) and self._kslice==slice(None):
+            XX_R=np.multiply(XX_R,self._expdK.reshape((1,1,self.nRvec)+(1,)*len(XX_R.shape[3:])),dtype=self.dtype_complex)
+            return self._rotate(self._fft( XX_R,hermitian=hermitian).astype(self.dtype_complex,copy=False)  )
+
+        def asymmetrize(comps):
+            """auxilary function : antisymmetric part over the first two cartesian indices"""
+            assert all(len(idx)>=2 for idx in comps) , "cannot antisymmetrize less then 2 indices"
+            rest=sorted(set(idx[2:] for idx in comps))
+            return {(c,)+r:comps[(a,b)+r]+[(-coef,i,d) for coef,i,d in comps[(b,a)+r]] 
+                          for c,(a,b) in enumerate(zip(alpha_A,beta_A)) for r in rest}
+
+        # every output component is a list of terms (coefficient, input component, derivative directions)
+        comps={idx:[(1,idx,())] for idx in np.ndindex(*XX_R.shape[3:])}
+        if asym_before:
+            comps=asymmetrize(comps)
         for i in range(der):
-            XX_R=1j*XX_R.reshape( (XX_R.shape)+(1,) )*self.cRvec.reshape((1,1,self.nRvec)+(1,)*len(XX_R.shape[3:])+(3,))
-        XX_R=asymmetrize(XX_R, asym_after)
-        return self._rotate(self.fft_R_to_k( XX_R,hermitian=hermitian)  )
+            comps={idx+(d,):[(coef,j,ders+(d,)) for coef,j,ders in terms] for idx,terms in comps.items() for d in range(3)}
+        if asym_after:
+            comps=asymmetrize(comps)
+
+        shape=tuple(np.max(list(comps.keys()),axis=0)+1)
+        iRk=self.cRvec*1j
+        XX_K=None
+        done={}
+        for idx,terms in comps.items():
+            key=tuple(sorted( (j,tuple(sorted(ders)),coef) for coef,j,ders in terms ))
+            if XX_K is not None and key in done:
+                XX_K[(slice(None),)*3+idx]=XX_K[(slice(None),)*3+done[key]]
+                continue
+            staged=np.zeros(XX_R.shape[:3],dtype=self.dtype_complex)
+            for coef,j,ders in terms:
+                weight=coef*self._expdK*np.prod(iRk[:,list(ders)],axis=1)
+                staged+=XX_R[(slice(None),)*3+j]*weight[None,None,:]
+            X_K=self._fft( staged,hermitian=hermitian)
+            if XX_K is None:
+                XX_K=np.empty(X_K.shape+shape,dtype=self.dtype_complex)
+            XX_K[(slice(None),)*3+idx]=X_K
+            done[key]=idx
+        return self._rotate(XX_K)
 
 
     @lazy_property.LazyProperty
@@ -114,40 +344,37 @@ class Data_K(System):
         return np.array([self.dK+np.array([ix*dkx,iy*dky,iz*dkz]) 
           for ix in range(self.NKFFT[0])
               for iy in range(self.NKFFT[1])
-                  for  iz in range(self.NKFFT[2])])%1
+                  for  iz in range(self.NKFFT[2])])[self._kslice]%1
 
 
     @lazy_property.LazyProperty
     def NKFFT_tot(self):
-        return np.prod(self.NKFFT)
+        "number of k-points (of the chunk, see k_chunks)"
+        return len(range(np.prod(self.NKFFT))[self._kslice])
 
 
 #    defining sets of degenerate states.  
-    @lazy_property.LazyProperty
+    @CachedProperty
     def degen(self):
-            A=[np.where(E[1:]-E[:-1]>self.degen_thresh)[0]+1 for E in self.E_K ]
-            A=[ [0,]+list(a)+[len(E)] for a,E in zip(A,self.E_K) ]
-            return [[(ib1,ib2) for ib1,ib2 in zip(a,a[1:]) ]    for a,e in zip(A,self.E_K)]
+        return DegenBlocks.from_energies(self.E_K,self.degen_thresh)
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def true_degen(self):
-            A=[np.where(E[1:]-E[:-1]>self.degen_thresh)[0]+1 for E in self.E_K ]
-            A=[ [0,]+list(a)+[len(E)] for a,E in zip(A,self.E_K) ]
-            return [[(ib1,ib2) for ib1,ib2 in deg if ib2-ib1>1]  for deg in self.degen]
+        return self.degen.select(self.degen.size>1)
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def E_K_degen(self):
-        return [np.array([np.mean(E[ib1:ib2]) for ib1,ib2 in deg]) for deg,E in zip(self.degen,self.E_K)]
+        return self.degen.split(self.degen.block_mean(self.E_K))
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def vel_nonabelian(self):
-        return [ [0.5*(S[ib1:ib2,ib1:ib2]+S[ib1:ib2,ib1:ib2].transpose((1,0,2)).conj()) for ib1,ib2 in deg] for S,deg in zip(self.V_H,self.degen)]
+        return self.degen.diagonal_blocks(0.5*(self.V_H+self.V_H.transpose((0,2,1,3)).conj()))
 
 
 ### TODO : check if it is really gaufge-covariant in case of isolated degeneracies
-    @lazy_property.LazyProperty
+    @CachedProperty
     def mass_nonabelian(self):
         return [ [S[ib1:ib2,ib1:ib2]
                    +sum(np.einsum("mla,lnb->mnab",X,Y) 
@@ -159,13 +386,13 @@ class Data_K(System):
                      for S,D,V,deg in zip( self.del2E_H,self.D_H,self.V_H,self.degen) ]
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def spin_nonabelian(self):
-        return [ [S[ib1:ib2,ib1:ib2] for ib1,ib2 in deg] for S,deg in zip(self.S_H,self.degen)]
+        return self.degen.diagonal_blocks(self.S_H)
 
 
 ##  TODO: When it works correctly - think how to optimize it
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Berry_nonabelian(self):
         print_my_name_start()
         sbc=[(+1,alpha_A,beta_A),(-1,beta_A,alpha_A)]
@@ -182,7 +409,7 @@ class Data_K(System):
         return res
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Berry_nonabelian_ext1(self):
         print_my_name_start()
         sbc=[(+1,alpha_A,beta_A),(-1,beta_A,alpha_A)]
@@ -192,7 +419,7 @@ class Data_K(System):
         print_my_name_end()
         return res
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Berry_nonabelian_ext2(self):
         print_my_name_start()
         sbc=[(+1,alpha_A,beta_A),(-1,beta_A,alpha_A)]
@@ -210,7 +437,7 @@ class Data_K(System):
 
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Berry_nonabelian_D(self):
         print_my_name_start()
         sbc=[(+1,alpha_A,beta_A),(-1,beta_A,alpha_A)]
@@ -227,7 +454,7 @@ class Data_K(System):
 
 
 ##  TODO: When it works correctly - think how to optimize it
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Morb_nonabelian(self):
         print_my_name_start()
         sbc=[(+1,alpha_A,beta_A),(-1,beta_A,alpha_A)]
@@ -247,24 +474,51 @@ class Data_K(System):
         return Morb
 
         
-    @property
+    @CachedProperty
     def HH_K(self):
-        return self.fft_R_to_k( self.HH_R, hermitian=True) 
+        return self._fft( self.HH_R*self._expdK[None,None,:], hermitian=True) 
+
+    def _eigh(self,values_only=False):
+        """ diagonalizes the stacked HH_K by calls of eigh (or eigvalsh) on chunks of kbatch k-points. 
+            With npar>1 the chunks are distributed over the threads of the shared pool (LAPACK releases the GIL)"""
+        HH_K=self.HH_K
+        NK=HH_K.shape[0]
+        kbatch=NK if self.kbatch is None else max(1,min(self.kbatch,NK))
+        chunks=[slice(ik,min(ik+kbatch,NK)) for ik in range(0,NK,kbatch)]
+        E_K=np.empty(HH_K.shape[:2],dtype=float)
+        UU=None if values_only else np.empty(HH_K.shape,dtype=HH_K.dtype)
+        def fun(sl):
+            if values_only:
+                E_K[sl]=np.linalg.eigvalsh(HH_K[sl])
+            else:
+                E_K[sl],UU[sl]=np.linalg.eigh(HH_K[sl])
+        get_pool(self.npar).map(fun,chunks)
+        return E_K,UU
 
-    @lazy_property.LazyProperty
+    def eigenvalues_only(self):
+        """ to be called before E_K is evaluated, if the eigenvectors will not be needed (e.g. for dos, cumdos).
+            Then E_K is obtained from eigvalsh. If UU_K is requested later anyway, it is evaluated separately"""
+        if not hasattr(self,'_UU'):
+            self._E_K_only=self._eigh(values_only=True)[0]
+
+    @CachedProperty
     def E_K(self):
         print_my_name_start()
-        EUU=self.poolmap(np.linalg.eigh,self.HH_K)
-        E_K=np.array([euu[0] for euu in EUU])
-        self._UU=np.array([euu[1] for euu in EUU])
+        if hasattr(self,'_E_K_only'):
+            E_K=self._E_K_only
+        else:
+            E_K,self._UU=self._eigh()
         print_my_name_end()
         return E_K
 
-    @lazy_property.LazyProperty
+    @CachedProperty
 #    @property
     def UU_K(self):
         print_my_name_start()
         self.E_K
+        if not hasattr(self,'_UU'):
+            # E_K was evaluated without the eigenvectors, see eigenvalues_only()
+            self._UU=self._eigh()[1]
         # the following is needed only for testing : 
         if self.random_gauge:
             from scipy.stats import unitary_group
@@ -276,11 +530,17 @@ class Data_K(System):
                     cnt+=1
                     s+=ib2-ib1
 #            print ("applied random rotations {} times, average degeneracy is {}-fold".format(cnt,s/max(cnt,1)))
+        self._UU=self._UU.astype(self.dtype_complex,copy=False)
         print_my_name_end()
         return self._UU
 
+    @CachedProperty
+    def E_K_work(self):
+        """ E_K in the working precision, to be used in products with the k-space matrices"""
+        return self.E_K.astype(self.dtype_real,copy=False)
 
-    @lazy_property.LazyProperty
+
+    @CachedProperty
     def delE_K(self):
         print_my_name_start()
         delE_K = np.einsum("klla->kla",self.V_H)
@@ -289,7 +549,7 @@ class Data_K(System):
         return delE_K.real
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def del2E_H(self):
         return self._R_to_k_H( self.HH_R, der=2 )
 
@@ -297,7 +557,7 @@ class Data_K(System):
     def del2E_H_diag(self):
         return np.einsum("knnab->knab",self.del2E_H).real
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def dEig_inv(self):
         dEig_threshold=1e-14
         dEig=self.E_K[:,:,None]-self.E_K[:,None,:]
@@ -305,38 +565,37 @@ class Data_K(System):
         dEig[select]=dEig_threshold
         dEig=1./dEig
         dEig[select]=0.
-        return dEig
+        return dEig.astype(self.dtype_real,copy=False)
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def D_H(self):
             return -self.V_H*self.dEig_inv[:, :,:,None]
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def V_H(self):
         self.E_K
         return self._R_to_k_H( self.HH_R, der=1 )
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Morb_Hbar(self):
-        return self._R_to_k_H( self.CC_R.copy() )
+        return self._R_to_k_H( self.CC_R )
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Morb_Hbar_diag(self):
         return np.einsum("klla->kla",self.Morb_Hbar).real
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Morb_Hbar_der(self):
         return self._R_to_k_H( self.CC_R, der=1 )
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Morb_Hbar_der_diag(self):
         return np.einsum("kllad->klad",self.Morb_Hbar_der).real
 
 
 
     
-   # @lazy_property.LazyProperty
-    @property
+    @CachedProperty
     def gdD(self):
          # evaluates tildeD  as three terms : gdD1[k,n,l,a,b] , gdD1[k,n,n',l,a,b] ,  gdD2[k,n,l',l,a,b] 
          # which after summing over l',n' will give the generalized derivative
@@ -350,8 +609,7 @@ class Data_K(System):
                                                                 
         return dDln,dDlln,dDlnn
 
-   # @lazy_property.LazyProperty
-    @property
+    @CachedProperty
     def gdAbar(self):
         dAln= self.A_Hbar_der
         dAlln= self.A_Hbar[:,:,:,None,:,None]*self.D_H[:,None,:,:,None,:]
@@ -359,8 +617,7 @@ class Data_K(System):
 
         return dAln,dAlln,dAlnn
 
-   # @lazy_property.LazyProperty
-    @property
+    @CachedProperty
     def gdBbar(self):
         dBln= self.B_Hbar_der
         dBlln= self.B_Hbar[:,:,:,None,:,None]*self.D_H[:,None,:,:,None,:]
@@ -368,27 +625,26 @@ class Data_K(System):
 
         return dBln,dBlln,dBlnn
 
-  #  @lazy_property.LazyProperty
-    @property
+    @CachedProperty
     def gdBbarplus(self):
         Aln,Alln,Alnn = self.gdAbar 
         Bln,Blln,Blnn = self.gdBbar
         A = self.A_Hbar
         V = self.V_H
-        dBPln=  Bln + Aln*self.E_K[:,None,:,None,None] 
-        dBPlln= Blln + Alln*self.E_K[:,None,None,:,None,None] 
-        dBPlnn= Blnn + Alnn*self.E_K[:,None,None,:,None,None] + A[:,:,:,None,:,None]*V[:,None,:,:,None,:]
+        dBPln=  Bln + Aln*self.E_K_work[:,None,:,None,None] 
+        dBPlln= Blln + Alln*self.E_K_work[:,None,None,:,None,None] 
+        dBPlnn= Blnn + Alnn*self.E_K_work[:,None,None,:,None,None] + A[:,:,:,None,:,None]*V[:,None,:,:,None,:]
 
         return dBPln,dBPlln,dBPlnn
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def gdOmegabar(self):
         dOn= self.Omega_bar_der_rediag.real
         dOln= (self.Omega_Hbar[:,:,:,:,None].transpose(0,2,1,3,4)*self.D_H[:,:,:,None,:]-self.D_H[:,:,:,None,:].transpose(0,2,1,3,4)*self.Omega_Hbar[:,:,:,:,None]).real
 
         return dOn,dOln
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def gdHbar(self):
         Hbar = self.Morb_Hbar
         dHn= self.Morb_Hbar_der_diag.real
@@ -401,10 +657,10 @@ class Data_K(System):
     def B_Hbarplus_dagger(self):
         B = self.B_Hbar
         A = self.A_Hbar
-        Bplus= (B+A*self.E_K[:,None,:,None]).conj()
+        Bplus= (B+A*self.E_K_work[:,None,:,None]).conj()
         return Bplus
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def derOmegaTr(self):
         b=alpha_A
         c=beta_A
@@ -423,12 +679,12 @@ class Data_K(System):
 
         return {'i':o,'oi':uo,'oii':uoo,'ooi':uuo}
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def derHplusTr(self):
         b=alpha_A
         c=beta_A
         N=None
-        E=self.E_K
+        E=self.E_K_work
         dHn, dHln = self.gdHbar
         dOn, dOln = self.gdOmegabar
         Onn = self.Omega_Hbar.transpose(0,2,1,3)
@@ -457,89 +713,89 @@ class Data_K(System):
         return {'i':o,'ii':oo,'oi':uo,'oii':uoo,'ooi':uuo}
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def A_Hbar(self):
-        return self._R_to_k_H(self.AA_R.copy())
+        return self._R_to_k_H(self.AA_R)
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def A_H(self):
         '''Generalized Berry connection matrix, A^(H) as defined in eqn. (25) of 10.1103/PhysRevB.74.195118.'''
         return self.A_Hbar + 1j*self.D_H
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def A_Hbar_der(self):
-        return  self._R_to_k_H(self.AA_R.copy(), der=1) 
+        return  self._R_to_k_H(self.AA_R, der=1) 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def S_H(self):
-        return  self._R_to_k_H( self.SS_R.copy() )
+        return  self._R_to_k_H( self.SS_R )
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def S_H_rediag(self):
         return np.einsum("knna->kna",self.S_H).real
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def SA_H(self):
-        return  self._R_to_k_H(self.SA_R.copy())
+        return  self._R_to_k_H(self.SA_R)
     
-    @lazy_property.LazyProperty
+    @CachedProperty
     def SHA_H(self):
-        return  self._R_to_k_H(self.SHA_R.copy())
+        return  self._R_to_k_H(self.SHA_R)
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def delS_H(self):
         """d_b S_a """
         return  self._R_to_k_H( self.SS_R[:,:,:,:,None], der=1 )
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def delS_H_rediag(self):
 #  d_b S_a
         return np.einsum("knnab->knab",self.delS_H).real
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Omega_Hbar(self):
         print_my_name_start()
         return  -self._R_to_k_H( self.AA_R, der=1, asym_after=True) 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def B_Hbar(self):
         print_my_name_start()
-        _BB_K=self._R_to_k_H( self.BB_R.copy(),hermitian=False)
+        _BB_K=self._R_to_k_H( self.BB_R,hermitian=False)
         select=(self.E_K<=self.frozen_max)
-        _BB_K[select]=self.E_K[select][:,None,None]*self.A_Hbar[select]
+        _BB_K[select]=self.E_K_work[select][:,None,None]*self.A_Hbar[select]
         return _BB_K
     
-    @lazy_property.LazyProperty
+    @CachedProperty
     def B_Hbar_der(self):
-        _BB_K=self._R_to_k_H( self.BB_R.copy(), der=1,hermitian=False)
+        _BB_K=self._R_to_k_H( self.BB_R, der=1,hermitian=False)
         return _BB_K
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def B_Hbarbar(self):
         print_my_name_start()
-        B= self.B_Hbar-self.A_Hbar[:,:,:,:]*self.E_K[:,None,:,None]
+        B= self.B_Hbar-self.A_Hbar[:,:,:,:]*self.E_K_work[:,None,:,None]
         print_my_name_end()
         return B
         
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Omega_Hbar_E(self):
          print_my_name_start()
-         return np.einsum("km,kmma->kma",self.E_K,self.Omega_Hbar).real
+         return np.einsum("km,kmma->kma",self.E_K_work,self.Omega_Hbar).real
 
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def A_E_A(self):
          print_my_name_start()
-         return np.einsum("kn,knma,kmna->kmna",self.E_K,self.A_Hbar[:,:,:,alpha_A],self.A_Hbar[:,:,:,beta_A]).imag
+         return np.einsum("kn,knma,kmna->kmna",self.E_K_work,self.A_Hbar[:,:,:,alpha_A],self.A_Hbar[:,:,:,beta_A]).imag
 
 
 
 
 #  for effective mass
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Db_Va_re(self):
          print_my_name_start()
          return (self.D_H[:,:,:,None,:]*self.V_H.transpose(0,2,1,3)[:,:,:,:,None]  - 
@@ -547,7 +803,7 @@ class Data_K(System):
                    ).real
 
 #  for spin derivative
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Db_Sa_re(self):
          print_my_name_start()
          return (self.D_H[:,:,:,None,:]*self.S_H.transpose(0,2,1,3)[:,:,:,:,None]  - 
@@ -556,7 +812,7 @@ class Data_K(System):
                
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def D_B(self):
          print_my_name_start()
          tmp=self.D_H.transpose((0,2,1,3))
@@ -566,35 +822,32 @@ class Data_K(System):
 
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def D_E_A(self):
          print_my_name_start()
          return np.array([
                   np.einsum("n,nma,mna->mna",ee,aa[:,:,alpha_A],dh[:,:,beta_A ]).real+
                   np.einsum("n,mna,nma->mna",ee,aa[:,:,beta_A ],dh[:,:,alpha_A]).real 
-                    for ee,aa,dh in zip(self.E_K,self.A_Hbar,self.D_H)])
+                    for ee,aa,dh in zip(self.E_K_work,self.A_Hbar,self.D_H)])
          
-    @lazy_property.LazyProperty
+    @CachedProperty
     def D_E_D(self):
          print_my_name_start()
-         X=-np.einsum("km,knma,kmna->kmna",self.E_K,self.D_H[:,:,:,alpha_A],self.D_H[:,:,:,beta_A ]).imag
+         X=-np.einsum("km,knma,kmna->kmna",self.E_K_work,self.D_H[:,:,:,alpha_A],self.D_H[:,:,:,beta_A ]).imag
          return (   X,-X.transpose( (0,2,1,3) ) )    #-np.einsum("km,knma,kmna->kmna",self.E_K,self.D_H[:,:,:,alpha_A],self.D_H[:,:,:,beta_A ]).imag ,
 
 
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Omega_bar_der(self):
         print_my_name_start()
-        _OOmega_K =  self.FFT_R_to_k( (
-                        self.AA_R[:,:,:,alpha_A]*self.cRvec[None,None,:,beta_A ] -     
-                        self.AA_R[:,:,:,beta_A ]*self.cRvec[None,None,:,alpha_A])[:,:,:,:,None]*self.cRvec[None,None,:,None,:]   , hermitian=True )
-        return self._rotate(_OOmega_K)
+        return -self._R_to_k_H( self.AA_R, der=2, asym_after=True)
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Omega_bar_der_rediag(self):
         return np.einsum("knnad->knad",self.Omega_bar_der).real
 
-    @lazy_property.LazyProperty
+    @CachedProperty
     def Omega_bar_D_re(self):
         return (self.Omega_Hbar.transpose(0,2,1,3)[:,:,:,:,None]*self.D_H[:,:,:,None,:]).real
 
@@ -645,3 +898,31 @@ class Data_K(System):
         return self.Hplusminus(self,-1,evalJ0=evalJ0,evalJ1=evalJ1,evalJ2=evalJ2)
 
 
+
+def precision_report(system,quantities=('A_Hbar','Omega_Hbar','V_H'),**kwargs):
+    """ evaluates the `quantities` (names of Data_K attributes) with Data_K(system,**kwargs) in double
+        and in single precision, prints and returns the maximal absolute and relative deviations of the 
+        single-precision results. For nested results (tuples, dicts, lists) all parts are compared.
+        The system should be built in double precision, otherwise the reference is not a double-precision one"""
+    if getattr(system,'precision','double')!='double':
+        raise ValueError("precision_report needs a system built with precision='double', found '{}'".format(system.precision))
+    def flatten(X):
+        if isinstance(X,dict):
+            return [x for k in sorted(X) for x in flatten(X[k])]
+        if isinstance(X,(list,tuple)):
+            return [x for Y in X for x in flatten(Y)]
+        return [np.asarray(X)]
+    data={prec:Data_K(system,precision=prec,**kwargs) for prec in PRECISIONS}
+    report={}
+    print ("{:>20s} {:>12s} {:>12s}".format("quantity","max abs dev","max rel dev"))
+    for q in quantities:
+        ref,single=[flatten(getattr(data[prec],q)) for prec in ('double','single')]
+        if len(ref)!=len(single) or any(r.shape!=x.shape for r,x in zip(ref,single)):
+            # e.g. different degeneracy structures
+            report[q]=(np.nan,np.nan)
+        else:
+            absdev=max([np.abs(r-x).max() if r.size>0 else 0. for r,x in zip(ref,single)]+[0.])
+            scale=max([np.abs(r).max() if r.size>0 else 0. for r in ref]+[0.])
+            report[q]=(absdev,absdev/scale if scale>0 else absdev)
+        print ("{:>20s} {:12.3e} {:12.3e}".format(q,*report[q]))
+    return report
@@ -0,0 +1,136 @@
+#                                                            #
+# This file is distributed as part of the WannierBerri code  #
+# under the terms of the GNU General Public License. See the #
+# file `LICENSE' in the root directory of the WannierBerri   #
+# distribution, or http://www.gnu.org/copyleft/gpl.txt       #
+#                                                            #
+# The WannierBerri code is hosted on GitHub:                 #
+# https://github.com/stepan-tsirkin/wannier-berri            #
+#                     written by                             #
+#           Stepan Tsirkin, University of Zurich             #
+#                                                            #
+#------------------------------------------------------------
+#
+#  a cache for the lazily evaluated quantities of Data_K,
+#  which follows their dependencies and obeys a memory limit
+#
+
+import numpy as np
+from collections import OrderedDict,defaultdict
+
+
+def nbytes(value):
+    "memory occupied by the arrays in value (which may be a nested dict/list/tuple)"
+    if hasattr(value,'nbytes'):
+        return value.nbytes
+    if isinstance(value,dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value,(list,tuple)):
+        return sum(nbytes(v) for v in value)
+    return 0
+
+
+class QuantityCache():
+    """ stores the evaluated quantities of one object. The dependencies are recorded while the quantities
+        are evaluated : everything accessed during the evaluation of X is a dependency of X, and X is its consumer.
+        If the total size exceeds `limit` (bytes, None for no limit), the entries are evicted :
+        first those whose consumers are all evaluated already, then the others, least recently used first.
+        The `retained` entries (expensive intermediates shared by several quantities) are evicted last, 
+        and only when all their consumers are evaluated. The `pinned` entries and those being evaluated 
+        are never evicted. Evicted quantities are evaluated again if needed"""
+
+    def __init__(self,limit=None,pinned=(),retained=()):
+        self.limit=limit
+        self.pinned=set(pinned)
+        self.retained=set(retained)
+        self._values=OrderedDict()   # in the order of the last access
+        self._nbytes={}
+        self.depends=defaultdict(set)
+        self.consumers=defaultdict(set)
+        self.evaluated=set()
+        self._stack=[]
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    @property
+    def size(self):
+        return sum(self._nbytes.values())
+
+    def get(self,name,fun,obj):
+        if len(self._stack)>0:
+            self.depends[self._stack[-1]].add(name)
+            self.consumers[name].add(self._stack[-1])
+        if name in self._values:
+            self.hits+=1
+            self._values.move_to_end(name)
+            return self._values[name]
+        self.misses+=1
+        self._stack.append(name)
+        try:
+            value=fun(obj)
+        finally:
+            self._stack.pop()
+        self._values[name]=value
+        self._nbytes[name]=nbytes(value)
+        self.evaluated.add(name)
+        self._evict(keep=name)
+        return value
+
+    def finished(self,name):
+        "all consumers of `name` (if any) have been evaluated"
+        consumers=self.consumers[name]
+        return len(consumers)>0 and all(c in self.evaluated and c not in self._stack for c in consumers)
+
+    def _evict(self,keep):
+        if self.limit is None:
+            return
+        size=self.size
+        while size>self.limit:
+            candidates=[n for n in self._values if n!=keep and n not in self.pinned and n not in self._stack]
+            finished=[n for n in candidates if self.finished(n)]
+            # in the order of preference, least recently used first within each
+            for group in ([n for n in finished if n not in self.retained],
+                          [n for n in candidates if n not in self.retained],
+                          [n for n in finished if n in self.retained]):
+                if len(group)>0:
+                    name=group[0]
+                    break
+            else:
+                break
+            del self._values[name]
+            size-=self._nbytes.pop(name)
+            self.evictions+=1
+
+    def clear(self):
+        self._values.clear()
+        self._nbytes.clear()
+
+    def __str__(self):
+        return "cache : {} entries, {:.1f} MB (limit {}), {} hits, {} misses, {} evictions".format(
+                  len(self._values),self.size/2**20, "none" if self.limit is None else "{:.1f} MB".format(self.limit/2**20),
+                  self.hits,self.misses,self.evictions)
+
+
+def get_cache(obj):
+    "the cache of obj, created at the first call with obj.cache_limit, obj.cache_pinned and obj.cache_keep"
+    cache=vars(obj).get('_quantity_cache')
+    if cache is None:
+        cache=vars(obj)['_quantity_cache']=QuantityCache(getattr(obj,'cache_limit',None),
+                         getattr(obj,'cache_pinned',()),getattr(obj,'cache_keep',()))
+    return cache
+
+
+class CachedProperty():
+    """ used like lazy_property.LazyProperty, but the value is kept in the QuantityCache of the instance,
+        so it may be evicted and evaluated again"""
+
+    def __init__(self,fun):
+        self.fun=fun
+        self.__name__=fun.__name__
+        self.__doc__=fun.__doc__
+
+    def __get__(self,obj,cls):
+        if obj is None:
+            return self
+        return get_cache(obj).get(self.__name__,self.fun,obj)
@@ -123,6 +123,9 @@ descriptions['Hall_spin'   ] = "Low field AHE, spin    part, in S/(cm*T)."
 descriptions['opt_conductivity'] = "Optical conductivity in S/cm"
 descriptions['opt_SHC'] = "Optical spin Hall conductivity in S/cm"
 
+# quantities which need only the energies, not the eigenvectors
+eigenvalues_only=set(['dos','cumdos'])
+
 # omega - for optical properties of insulators
 # Efrmi - for transport properties of (semi)conductors
 
@@ -151,14 +154,23 @@ def intProperty(data,quantities=[],Efermi=None,omega=None,smoothers={},energies=
     
 
     results={}
+    # with data.kchunk set, the results of the chunks are accumulated before the next chunk is evaluated
+    for chunk in data.k_chunks():
+        if len(quantities)>0 and set(quantities)<=eigenvalues_only:
+            chunk.eigenvalues_only()
+        weight=chunk.NKFFT_tot/data.NKFFT_tot
+        for q in quantities:
+            __parameters={}
+            for param in additional_parameters[q]:
+                if param in parameters:
+                     __parameters[param]=parameters[param]
+                else :
+                     __parameters[param]=additional_parameters[q][param]
+            res=calculators[q](chunk,_energy(q),**__parameters)
+            if chunk is not data:
+                res=res*weight
+            results[q]=res if q not in results else results[q]+res
     for q in quantities:
-        __parameters={}
-        for param in additional_parameters[q]:
-            if param in parameters:
-                 __parameters[param]=parameters[param]
-            else :
-                 __parameters[param]=additional_parameters[q][param]
-        results[q]=calculators[q](data,_energy(q),**__parameters)
         results[q].set_smoother(_smoother(q))
 
     return INTresult( results=results )
@@ -0,0 +1,92 @@
+#                                                            #
+# This file is distributed as part of the WannierBerri code  #
+# under the terms of the GNU General Public License. See the #
+# file `LICENSE' in the root directory of the WannierBerri   #
+# distribution, or http://www.gnu.org/copyleft/gpl.txt       #
+#                                                            #
+# The WannierBerri code is hosted on GitHub:                 #
+# https://github.com/stepan-tsirkin/wannier-berri            #
+#                     written by                             #
+#           Stepan Tsirkin, University of Zurich             #
+#                                                            #
+#------------------------------------------------------------
+#
+#  worker pools shared by all Data_K objects of a process
+#
+
+import os
+import atexit
+from multiprocessing.pool import ThreadPool
+
+
+class WorkerPool():
+    """ a pool of npar worker threads with an explicit lifetime : shutdown() or use as a context manager.
+        Threads are used, because the work mapped over the pool (e.g. eigh on chunks of k-points) 
+        is done by numpy kernels which release the GIL, and the arguments need not be pickled.
+        The threads are started at the first map() over more than one item. 
+        If npar<=1 or the pool cannot be created, map() runs serially, as it does after shutdown()"""
+
+    def __init__(self,npar):
+        self.npar=npar
+        self.closed=False
+        self._pool=None
+
+    @property
+    def serial(self):
+        return self.npar<=1 or self.closed
+
+    def map(self,fun,lst):
+        lst=list(lst)
+        if self.serial or len(lst)<=1:
+            return [fun(x) for x in lst]
+        if self._pool is None:
+            try:
+                self._pool=ThreadPool(self.npar)
+            except Exception as err:
+                print ('failed to create a pool of {} workers, running serially : {}'.format(self.npar,err))
+                self.npar=1
+                return [fun(x) for x in lst]
+        return self._pool.map(fun,lst)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool=None
+        self.closed=True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.shutdown()
+
+
+# the pools of this process : npar -> WorkerPool. The pid is stored to avoid
+# using pools inherited by a forked child
+_pools={}
+_pools_pid=os.getpid()
+
+
+def get_pool(npar):
+    """ returns the pool of npar workers of this process, creating it at the first call"""
+    global _pools,_pools_pid
+    if _pools_pid!=os.getpid():
+        _pools={}
+        _pools_pid=os.getpid()
+    pool=_pools.get(npar)
+    if pool is None or pool.closed:
+        pool=_pools[npar]=WorkerPool(npar)
+    return pool
+
+
+def shutdown_pools():
+    """ shuts down all pools of this process. Later calls of get_pool() create new ones"""
+    global _pools
+    if _pools_pid==os.getpid():
+        for pool in _pools.values():
+            pool.shutdown()
+    _pools={}
+
+
+atexit.register(shutdown_pools)
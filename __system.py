@@ -12,8 +12,13 @@
 #------------------------------------------------------------
 
 import numpy as np
-from scipy.io import FortranFile as FF
+import scipy.sparse
+import os
 import copy
+import struct
+import zipfile
+import tempfile
+import atexit
 import lazy_property
 
 from .__utility import str2bool, alpha_A, beta_A , real_recip_lattice
@@ -23,6 +28,13 @@ from termcolor import cprint
 
 
 
+# version of the archive written by System.save() 
+SYSTEM_ARCHIVE_VERSION=1
+SYSTEM_MATRICES=['HH','AA','BB','CC','FF','SS','SA','SHA']
+# complex and real dtypes for the precision modes
+PRECISIONS={'double':(np.complex128,np.float64),'single':(np.complex64,np.float32)}
+
+
 class System():
 
     def __init__(self,seedname="wannier90",tb_file=None,
@@ -36,7 +48,8 @@ class System():
                     frozen_max=-np.Inf,
                     random_gauge=False,
                     degen_thresh=-1 ,
-                    old_format=False
+                    old_format=False,
+                    precision='double'
                                 ):
 
 
@@ -47,6 +60,7 @@ class System():
         self.random_gauge=random_gauge
         self.degen_thresh=degen_thresh
         self.old_format=old_format
+        self.set_precision(precision)
         self.AA_R=None
         self.BB_R=None
         self.CC_R=None
@@ -93,64 +107,150 @@ class System():
         if getCC:
            getBB=True
 
-        self.HH_R=self.__getMat('HH')
-
-
-        
-        if getAA:
-            self.AA_R=self.__getMat('AA')
+        # the matrices are not read here, but at the first access (see __getattr__)
+        self._lazy_R={'HH_R':('file','HH')}
+        for X,get in [('AA',getAA),('BB',getBB),('SS',getSS),('SA',getSA),('SHA',getSHA)]:
+            if get:
+                self._lazy_R[X+'_R']=('file',X)
+        for X,get in [('CC',getCC),('FF',getFF)]:
+            if get:
+                self._lazy_R[X+'_R']=('file_ab',X)
+        for XR in self._lazy_R:
+            vars(self).pop(XR,None)
 
-        if getBB:
-            self.BB_R=self.__getMat('BB')
-        
-        if getCC:
-            try:
-                self.CC_R=1j*self.__getMat('CCab')
-            except:
-                _CC_R=self.__getMat('CC')
-                self.CC_R=1j*(_CC_R[:,:,:,alpha_A,beta_A]-_CC_R[:,:,:,beta_A,alpha_A])
+        cprint ("Reading the system finished successfully",'green', attrs=['bold'])
 
-        if getFF:
+    def __getattr__(self,name):
+        # called only if `name` is not found the usual way : the R-space matrices registered 
+        # in self._lazy_R are loaded at first access and stored as ordinary attributes
+        lazy=vars(self).get('_lazy_R',{})
+        if name in lazy:
+            value=self._load_R(name,*lazy[name])
+            if name!='HH_R':
+                value=value.astype(self.dtype_complex,copy=False)
+            setattr(self,name,value)
+            return value
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__,name))
+
+    def _load_R(self,name,kind,arg):
+        """ loads the R-space matrix `name` registered in self._lazy_R as (kind,arg) """
+        if kind=='file':
+            return self.__getMat(arg)
+        elif kind=='file_ab':
             try:
-                self.FF_R=1j*self.__getMat('FFab')
-            except:
-                _FF_R=self.__getMat('FF')
-                self.FF_R=1j*(_FF_R[:,:,:,alpha_A,beta_A]-_FF_R[:,:,:,beta_A,alpha_A])
-
-        if getSS:
-            self.SS_R=self.__getMat('SS')
-
-        if getSA:
-            self.SA_R=self.__getMat('SA')
-        if getSHA:
-            self.SHA_R=self.__getMat('SHA')
-
-        cprint ("Reading the system finished successfully",'green', attrs=['bold'])
+                return 1j*self.__getMat(arg+'ab')
+            except OSError:
+                XX_R=self.__getMat(arg)
+                return 1j*(XX_R[:,:,:,alpha_A,beta_A]-XX_R[:,:,:,beta_A,alpha_A])
+        elif kind=='archive':
+            return load_npz(arg,mmap=True,names=[name])[name]
+        else:
+            raise ValueError("unknown way '{}' to load {}".format(kind,name))
+
+    def share_memory(self,path=None):
+        """ moves the R-space matrices into an archive (see save()) and maps them from there read-only.
+            By default the archive is a temporary file in /dev/shm (if present), removed at exit. 
+            Pickled copies of the system (e.g. sent to worker processes) then carry only the path, 
+            and all processes on the node map the same physical pages"""
+        if path is None:
+            shm="/dev/shm"
+            fd,path=tempfile.mkstemp(prefix="wberri_system_",suffix=".npz",dir=shm if os.path.isdir(shm) else None)
+            os.close(fd)
+            atexit.register(_remove_file,path)
+        self.save(path)
+        lazy=vars(self).setdefault('_lazy_R',{})
+        for X in SYSTEM_MATRICES:
+            if self.has_R(X+'_R'):
+                vars(self).pop(X+'_R',None)
+                lazy[X+'_R']=('archive',path)
+        return path
+
+    def __getstate__(self):
+        # the matrices mapped from an archive are not pickled, they are mapped again by the receiving process
+        state=vars(self).copy()
+        for name,(kind,arg) in vars(self).get('_lazy_R',{}).items():
+            if kind=='archive':
+                state.pop(name,None)
+        return state
+
+    def set_precision(self,precision):
+        """ precision='single' stores all R-space matrices except HH_R as complex64. HH_R is kept in double 
+            precision, because the eigenvectors near degeneracies are sensitive to it """
+        if precision not in PRECISIONS:
+            raise ValueError("precision should be one of {}, found '{}'".format(list(PRECISIONS.keys()),precision))
+        self.precision=precision
+        for X in SYSTEM_MATRICES:
+            XX_R=vars(self).get(X+'_R')
+            if X!='HH' and XX_R is not None:
+                vars(self)[X+'_R']=XX_R.astype(self.dtype_complex,copy=False)
 
+    @property
+    def dtype_complex(self):
+        return PRECISIONS[getattr(self,'precision','double')][0]
 
-    def to_tb_file(self,tb_file=None):
+    @property
+    def dtype_real(self):
+        return PRECISIONS[getattr(self,'precision','double')][1]
+
+    def has_R(self,name):
+        """ checks if the R-space matrix `name` (e.g. 'AA_R') is present, without loading it """
+        return name in vars(self).get('_lazy_R',{}) or vars(self).get(name) is not None
+
+    def release(self,*names):
+        """ drops the R-space matrices `names` (all except HH_R, if none given) from memory. 
+            Those which can be loaded lazily are re-loaded at the next access, the others become None"""
+        if len(names)==0:
+            names=[X+'_R' for X in SYSTEM_MATRICES if X!='HH']
+        lazy=vars(self).get('_lazy_R',{})
+        for name in names:
+            if name in lazy:
+                vars(self).pop(name,None)
+            elif name in vars(self):
+                vars(self)[name]=None
+
+
+    def to_tb_file(self,tb_file=None,binary=False):
+        """ writes the _tb.dat file. Each R-block is formatted by a single %-operation on a precomputed template.
+            With binary=True an uncompressed .npz with the same content (Ndegen, iRvec and the HH and AA blocks 
+            multiplied by Ndegen) is written instead, which may be read back by np.load() or load_npz()"""
         if tb_file is None: 
-            tb_file=self.seedname+"_fromchk_tb.dat"
+            tb_file=self.seedname+("_fromchk_tb.npz" if binary else "_fromchk_tb.dat")
+        num_wann=self.num_wann
+        Ndegen=np.asarray(self.Ndegen)
+        write_AA=self.AA_R is not None
+        if binary:
+            arrays=dict(real_lattice=self.real_lattice,num_wann=np.array(num_wann),nRvec=np.array(self.nRvec),
+                        Ndegen=Ndegen,iRvec=np.asarray(self.iRvec),
+                        HH=self.HH_R*Ndegen[None,None,:])
+            if write_AA:
+                arrays['AA']=self.AA_R*Ndegen[None,None,:,None]
+            with open(tb_file,"wb") as f:
+                np.savez(f,**arrays)
+            return
         f=open(tb_file,"w")
         f.write("written by wannier-berri form the chk file\n")
-#        cprint ("reading TB file {0} ( {1} )".format(tb_file,l.strip()),'green', attrs=['bold'])
         np.savetxt(f,self.real_lattice)
-        f.write("{}\n".format(self.num_wann))
+        f.write("{}\n".format(num_wann))
         f.write("{}\n".format(self.nRvec))
         for i in range(0,self.nRvec,15):
-            a=self.Ndegen[i:min(i+15,self.nRvec)]
+            a=Ndegen[i:min(i+15,self.nRvec)]
             f.write("  ".join("{:2d}".format(x) for x in a)+"\n")
-        for iR in range(self.nRvec):
-            f.write("\n  {0:3d}  {1:3d}  {2:3d}\n".format(*tuple(self.iRvec[iR])))
-            f.write("".join("{0:3d} {1:3d} {2:15.8e} {3:15.8e}\n".format(
-                         m+1,n+1,self.HH_R[m,n,iR].real*self.Ndegen[iR],self.HH_R[m,n,iR].imag*self.Ndegen[iR]) 
-                             for n in range(self.num_wann) for m in range(self.num_wann)) )
-        if hasattr(self,'AA_R'):
-          for iR in range(self.nRvec):
-            f.write("\n  {0:3d}  {1:3d}  {2:3d}\n".format(*tuple(self.iRvec[iR])))
-            f.write("".join("{0:3d} {1:3d} ".format(
-                         m+1,n+1) + " ".join("{:15.8e} {:15.8e}".format(a.real,a.imag) for a in self.AA_R[m,n,iR]*self.Ndegen[iR] )+"\n"
-                             for n in range(self.num_wann) for m in range(self.num_wann)) )
+        # the rows go with n (second index) outer and m inner; Fortran order of the [m,n] block
+        nm=[(m+1,n+1) for n in range(num_wann) for m in range(num_wann)]
+        template_HH="".join("%3d %3d %%15.8e %%15.8e\n"%mn for mn in nm)
+        template_AA="".join("%3d %3d "%mn+" ".join(["%15.8e %15.8e"]*3)+"\n" for mn in nm)
+        template_R="\n  %3d  %3d  %3d\n"
+        def write_blocks(XX_R,template):
+            block=np.empty((num_wann,num_wann)+XX_R.shape[3:]+(2,))
+            for iR in range(self.nRvec):
+                XX=XX_R[:,:,iR]*Ndegen[iR]
+                block[...,0]=XX.real
+                block[...,1]=XX.imag
+                f.write(template_R%tuple(self.iRvec[iR]))
+                f.write(template%tuple(block.swapaxes(0,1).ravel().tolist()))
+        write_blocks(self.HH_R,template_HH)
+        if write_AA:
+            write_blocks(self.AA_R,template_AA)
         f.close()
         
 
@@ -192,100 +292,229 @@ class System():
 
 
 
-    def __getMat(self,suffix):
+    def save(self,path):
+        """ saves the fully built system (lattices, R-vectors and all R-space matrices, already mapped by ws_dist)
+            into a single uncompressed .npz archive, which may be memory-mapped by System.load()"""
+        arrays=dict(
+                 version=np.array(SYSTEM_ARCHIVE_VERSION),
+                 seedname=np.array(self.seedname),
+                 num_wann=np.array(self.num_wann),
+                 iRvec=np.asarray(self.iRvec),
+                 Ndegen=np.asarray(self.Ndegen),
+                 real_lattice=self.real_lattice,
+                 recip_lattice=self.recip_lattice,
+                 frozen_max=np.array(self.frozen_max),
+                 random_gauge=np.array(self.random_gauge),
+                 degen_thresh=np.array(self.degen_thresh),
+                 precision=np.array(getattr(self,'precision','double')) )
+        for X in SYSTEM_MATRICES:
+            XX_R=getattr(self,X+'_R',None)
+            if XX_R is not None:
+                arrays[X+'_R']=np.asarray(XX_R)
+        # write through a file object, so that np.savez does not append '.npz' to the path
+        with open(path,"wb") as f:
+            np.savez(f,**arrays)
+        print ("system saved to {} ({:.1f} MB)".format(path,os.path.getsize(path)/2**20))
+
+    @classmethod
+    def load(cls,path,mmap=True):
+        """ loads a system written by System.save(). With mmap=True the R-space matrices are 
+            memory-mapped read-only from the archive, so they are paged in only when used """
+        arrays=load_npz(path,mmap=mmap)
+        version=int(arrays.pop('version'))
+        if version!=SYSTEM_ARCHIVE_VERSION:
+            raise ValueError("archive {} has version {}, while version {} is expected".format(path,version,SYSTEM_ARCHIVE_VERSION))
+        system=cls.__new__(cls)
+        system.seedname=str(arrays.pop('seedname'))
+        system.num_wann=int(arrays.pop('num_wann'))
+        system.frozen_max=float(arrays.pop('frozen_max'))
+        system.random_gauge=bool(arrays.pop('random_gauge'))
+        system.degen_thresh=float(arrays.pop('degen_thresh'))
+        system.old_format=False
+        system.precision=str(arrays.pop('precision','double'))
+        system.iRvec=np.array(arrays.pop('iRvec'))
+        system.Ndegen=np.array(arrays.pop('Ndegen'))
+        system.nRvec0=len(system.Ndegen)
+        system.real_lattice=np.array(arrays.pop('real_lattice'))
+        system.recip_lattice=np.array(arrays.pop('recip_lattice'))
+        system.ws_map=None
+        system._lazy_R={}
+        for X in SYSTEM_MATRICES:
+            XR=X+'_R'
+            if XR not in arrays:
+                setattr(system,XR,None)
+            elif mmap:
+                # mapped again at the first access, so that release() is possible
+                system._lazy_R[XR]=('archive',path)
+                del arrays[XR]
+            else:
+                setattr(system,XR,arrays.pop(XR))
+        if len(arrays)>0:
+            raise ValueError("unknown entries in archive {} : {}".format(path,list(arrays.keys())))
+        cprint ("system loaded from {} : {} Wannier functions, {} R-vectors".format(path,system.num_wann,system.nRvec),'green', attrs=['bold'])
+        return system
 
-        f=FF(self.seedname+"_" + suffix+"_R"+(".dat" if self.old_format else ""))
-        MM_R=np.array([[np.array(f.read_record('2f8'),dtype=float) for m in range(self.num_wann)] for n in range(self.num_wann)])
-        MM_R=MM_R[:,:,:,0]+1j*MM_R[:,:,:,1]
-        f.close()
-        ncomp=MM_R.shape[2]/self.nRvec0
-        if ncomp==1:
-            result=MM_R/self.Ndegen[None,None,:]
-        elif ncomp==3:
-            result= MM_R.reshape(self.num_wann, self.num_wann, 3, self.nRvec0).transpose(0,1,3,2)/self.Ndegen[None,None,:,None]
-        elif ncomp==9:
-            result= MM_R.reshape(self.num_wann, self.num_wann, 3,3, self.nRvec0).transpose(0,1,4,3,2)/self.Ndegen[None,None,:,None,None]
-        else:
-            raise RuntimeError("in __getMat: invalid ncomp : {0}".format(ncomp))
+
+    def __getMat(self,suffix):
+        result=read_mat_R(self.seedname+"_" + suffix+"_R"+(".dat" if self.old_format else ""),
+                               self.num_wann,self.Ndegen)
         if self.ws_map is None:
             return result
         else:
             return self.ws_map(result)
         
 
+def read_mat_R(filename,num_wann,Ndegen):
+    """ reads the real-space matrix written by postw90 as num_wann x num_wann Fortran records,
+        each holding ncomp*nRvec complex numbers (ncomp = 1, 3 or 9). The file is mapped
+        at once and divided by Ndegen directly into the final array num_wann x num_wann x nRvec [x 3 [x 3]]"""
+    nRvec=len(Ndegen)
+    with open(filename,"rb") as f:
+        reclen=int(np.fromfile(f,dtype=np.uint32,count=1)[0])
+    ncomp=reclen/(16*nRvec)
+    if ncomp not in (1,3,9):
+        raise RuntimeError("in __getMat: invalid ncomp : {0}".format(ncomp))
+    ncomp=int(ncomp)
+    rec_dtype=np.dtype([('head',np.uint32),('data',np.complex128,ncomp*nRvec),('tail',np.uint32)])
+    if os.path.getsize(filename)!=num_wann**2*rec_dtype.itemsize:
+        raise RuntimeError("in __getMat: size of {} does not match {}x{} records of length {}".format(filename,num_wann,num_wann,reclen))
+    records=np.memmap(filename,dtype=rec_dtype,mode='r',shape=(num_wann,num_wann))
+    if np.any(records['head']!=reclen) or np.any(records['tail']!=reclen):
+        raise RuntimeError("in __getMat: inconsistent record markers in {}".format(filename))
+    MM_R=records['data']
+    if ncomp==1:
+        Ndegen=Ndegen[None,None,:]
+    elif ncomp==3:
+        MM_R=MM_R.reshape(num_wann, num_wann, 3, nRvec).transpose(0,1,3,2)
+        Ndegen=Ndegen[None,None,:,None]
+    elif ncomp==9:
+        MM_R=MM_R.reshape(num_wann, num_wann, 3,3, nRvec).transpose(0,1,4,3,2)
+        Ndegen=Ndegen[None,None,:,None,None]
+    result=np.empty(MM_R.shape,dtype=complex)
+    np.divide(MM_R,Ndegen,out=result)
+    del records,MM_R
+    return result
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def load_npz(path,mmap=True,names=None):
+    """ reads the arrays `names` (all if None) from an uncompressed .npz archive. With mmap=True every array 
+        (except scalars and empty ones) is returned as a read-only np.memmap pointing directly into the archive """
+    if not mmap:
+        with np.load(path) as f:
+            return {k:f[k] for k in f.files if names is None or k in names}
+    result={}
+    with zipfile.ZipFile(path) as zf, open(path,"rb") as f:
+        for info in zf.infolist():
+            name=info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if names is not None and name not in names:
+                continue
+            if info.compress_type!=zipfile.ZIP_STORED:
+                raise ValueError("{} in {} is compressed and cannot be memory-mapped, use mmap=False".format(name,path))
+            # local file header : 30 bytes , then the file name and the extra field
+            f.seek(info.header_offset)
+            header=f.read(30)
+            if header[:4]!=b"PK\x03\x04":
+                raise RuntimeError("invalid local header of {} in {}".format(name,path))
+            len_name,len_extra=struct.unpack("<HH",header[26:30])
+            f.seek(info.header_offset+30+len_name+len_extra)
+            version=np.lib.format.read_magic(f)
+            if version==(1,0):
+                shape,fortran_order,dtype=np.lib.format.read_array_header_1_0(f)
+            else:
+                shape,fortran_order,dtype=np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError("{} in {} contains python objects and cannot be memory-mapped".format(name,path))
+            if len(shape)==0 or np.prod(shape)==0:
+                result[name]=np.fromfile(f,dtype=dtype,count=int(np.prod(shape))).reshape(shape)
+            else:
+                result[name]=np.memmap(path,dtype=dtype,mode='r',offset=f.tell(),shape=shape,
+                                             order='F' if fortran_order else 'C')
+    return result
+
+
 #
 # the following  implements the use_ws_distance = True  (see Wannier90 documentation for details)
 #
 
 
 
-class map_1R():
-   def __init__(self,lines,irvec):
-       lines_split=[np.array(l.split(),dtype=int) for l in lines]
-       self.dict={(l[0]-1,l[1]-1):l[2:].reshape(-1,3) for l in lines_split}
-       self.irvec=np.array([irvec])
-       
-   def __call__(self,i,j):
-       try :
-           return self.dict[(i,j)]
-       except KeyError:
-           return self.irvec
-          
-
 class ws_dist_map():
+    """ the map is stored as a sparse matrix acting on the flattened (iw,jw,iR) index
+        of a matrix  num_wann x num_wann x nRvec x ...  , mapping it to the new R-vectors 
+        _iRvec_ordered (all trailing components at once) """
         
     def __call__(self,matrix):
-        ndim=len(matrix.shape)-3
-        num_wann=matrix.shape[0]
-        reshaper=(num_wann,num_wann)+(1,)*ndim
-#        print ("check:",matrix.shape,reshaper,ndim)
-        matrix_new=np.array([ sum(matrix[:,:,ir]*self._iRvec_new[irvecnew][ir].reshape(reshaper)
-                                  for ir in self._iRvec_new[irvecnew] ) 
-                                       for irvecnew in self._iRvec_ordered]).transpose( (1,2,0)+tuple(range(3,3+ndim)) )
+        """ maps one matrix by a sparse-dense product. The result is the product itself, reshaped (not copied)"""
+        num_wann,_,nRvec=matrix.shape[:3]
+        matrix_new=self._sparse.dot(matrix.reshape(num_wann*num_wann*nRvec,-1)).reshape( 
+                             (num_wann,num_wann,len(self._iRvec_ordered))+matrix.shape[3:] )
         assert ( np.abs(matrix_new.sum(axis=2)-matrix.sum(axis=2)).max()<1e-12)
         return matrix_new
 
-    def _add_star(self,ir,irvec_new,iw,jw):
-        weight=1./irvec_new.shape[0]
-        for irv in irvec_new:
-            self._add(ir,irv,iw,jw,weight)
-
-
-    def _add(self,ir,irvec_new,iw,jw,weight):
-        irvec_new=tuple(irvec_new)
-        if not (irvec_new in self._iRvec_new):
-             self._iRvec_new[irvec_new]=dict()
-        if not ir in self._iRvec_new[irvec_new]:
-             self._iRvec_new[irvec_new][ir]=np.zeros((self.num_wann,self.num_wann),dtype=float)
-        self._iRvec_new[irvec_new][ir][iw,jw]+=weight
+    def map_many(self,matrices):
+        """ maps several matrices (sharing num_wann and nRvec), one by one with the same sparse operator, 
+            so that no combined copy of the inputs is formed"""
+        return [self(m) for m in matrices]
 
-    def _init_end(self,nRvec):
-        self._iRvec_ordered=sorted(self._iRvec_new)
-        for ir  in range(nRvec):
-            chsum=0
-            for irnew in self._iRvec_new:
-                if ir in self._iRvec_new[irnew]:
-                    chsum+=self._iRvec_new[irnew][ir]
-            chsum=np.abs(chsum-np.ones( (self.num_wann,self.num_wann) )).sum() 
-            if chsum>1e-12: print ("WARNING: Check sum for {0} : {1}".format(ir,chsum))
+    def _init_sparse(self,nRvec,ir,irvec_new,iw,jw,weight):
+        """ builds the sparse map from the list of contributions : 
+             the element (iw,jw) of the old R-vector `ir` goes with `weight` to the new R-vector `irvec_new` """
+        nw=self.num_wann
+        self._iRvec_ordered,irnew=np.unique(irvec_new,axis=0,return_inverse=True)
+        irnew=irnew.reshape(-1)
+        nRvec_new=len(self._iRvec_ordered)
+        self._sparse=scipy.sparse.csr_matrix( (weight,((iw*nw+jw)*nRvec_new+irnew,(iw*nw+jw)*nRvec+ir)),
+                          shape=(nw*nw*nRvec_new,nw*nw*nRvec) )
+        chsum=np.abs(np.bincount((ir*nw+iw)*nw+jw,weights=weight,minlength=nRvec*nw*nw)-1).reshape(nRvec,-1).sum(axis=1)
+        for irold in np.where(chsum>1e-12)[0]:
+            print ("WARNING: Check sum for {0} : {1}".format(irold,chsum[irold]))
 
 
 
 class ws_dist_map_read(ws_dist_map):
+    """ reads the ws_dist section of the _R.info file : first nRvec lines ending with the number of entries
+        for each R-vector, followed by the entries `iw jw  R1 R2 ...` (the equivalent R-vectors).
+        The section is parsed in one pass into a flat integer array with cumulative offsets per line. 
+        Pairs (iw,jw) not listed for an R-vector keep the original R-vector"""
     def __init__(self,iRvec,num_wann,lines):
         nRvec=iRvec.shape[0]
-        self.num_wann=num_wann
-        self._iRvec_new=dict()
+        nw=self.num_wann=num_wann
         n_nonzero=np.array([l.split()[-1] for l in lines[:nRvec]],dtype=int)
-        lines=lines[nRvec:]
-        for ir,nnz in enumerate(n_nonzero):
-            map1r=map_1R(lines[:nnz],iRvec[ir])
-            for iw in range(num_wann):
-                for jw in range(num_wann):
-                    self._add_star(ir,map1r(iw,jw),iw,jw)
-            lines=lines[nnz:]
-        self._init_end(nRvec)
-
-        
-
+        entries=[l.split() for l in lines[nRvec:nRvec+n_nonzero.sum()]]
+        ntok=np.array([len(l) for l in entries],dtype=int)
+        if len(entries)!=n_nonzero.sum() or np.any(ntok<5) or np.any((ntok-2)%3!=0):
+            raise RuntimeError("the ws_dist section of the _R.info file is corrupted")
+        flat=np.array([t for l in entries for t in l],dtype=int)
+        offset=np.cumsum(ntok)-ntok
+        ir_line=np.repeat(np.arange(nRvec),n_nonzero)
+        iw_line=flat[offset]-1
+        jw_line=flat[offset+1]-1
+        # if a pair is listed several times for the same R-vector, the last line counts
+        key=(ir_line*nw+iw_line)*nw+jw_line
+        last=len(key)-1-np.unique(key[::-1],return_index=True)[1]
+        nvec=np.zeros(len(key),dtype=int)
+        nvec[last]=(ntok[last]-2)//3
+        # the equivalent R-vectors of all lines, each contributing with weight 1/nvec
+        line=np.repeat(np.arange(len(key)),nvec)
+        start=np.cumsum(nvec)-nvec
+        pos=offset[line]+2+3*(np.arange(len(line))-start[line])
+        irvec_new=flat[pos[:,None]+np.arange(3)[None,:]]
+        weight=1./nvec[line]
+        # the pairs which are not listed
+        listed=np.zeros((nRvec,nw,nw),dtype=bool)
+        listed[ir_line,iw_line,jw_line]=True
+        ir0,iw0,jw0=np.nonzero(~listed)
+        self._init_sparse(nRvec,
+                          np.concatenate( (ir_line[line],ir0) ),
+                          np.concatenate( (irvec_new,iRvec[ir0]) ),
+                          np.concatenate( (iw_line[line],iw0) ),
+                          np.concatenate( (jw_line[line],jw0) ),
+                          np.concatenate( (weight,np.ones(len(ir0))) ) )
 
@@ -36,6 +36,8 @@ class System_w90(System):
                     random_gauge=False,
                     degen_thresh=-1 ,
                     fft='fftw',
+                    cache=False,
+                    precision='double',
                     npar=multiprocessing.cpu_count()  ):
 
         self.seedname=seedname
@@ -74,6 +76,7 @@ class System_w90(System):
         self.frozen_max=frozen_max
         self.random_gauge=random_gauge
         self.degen_thresh=degen_thresh
+        self.set_precision(precision)
 
         chk=CheckPoint(self.seedname)
         self.real_lattice,self.recip_lattice=real_recip_lattice(chk.real_lattice,chk.recip_lattice)
@@ -82,9 +85,9 @@ class System_w90(System):
         self.nRvec0=len(self.iRvec)
         self.num_wann=chk.num_wann
 
-        eig=EIG(seedname)
+        eig=EIG(seedname,cache=cache)
         if getAA or getBB:
-            mmn=MMN(seedname)
+            mmn=MMN(seedname,cache=cache)
 
         kpt_mp_grid=[tuple(k) for k in np.array( np.round(chk.kpt_latt*np.array(chk.mp_grid)[None,:]),dtype=int)%chk.mp_grid]
 #        print ("kpoints:",kpt_mp_grid)
@@ -100,39 +103,39 @@ class System_w90(System):
 #            print (i,self.iRvec[i],"H(R)=",self.HH_R[0,0,i])
 
         if getAA:
-            AAq=chk.get_AA_q(mmn,transl_inv=transl_inv)
+            AAq=chk.get_AA_q(mmn,transl_inv=transl_inv,npar=npar)
             t0=time()
             self.AA_R=fourier_q_to_R_loc(AAq)
             timeFFT+=time()-t0
 
         if getBB:
             t0=time()
-            self.BB_R=fourier_q_to_R_loc(chk.get_AA_q(mmn,eig))
+            self.BB_R=fourier_q_to_R_loc(chk.get_AA_q(mmn,eig,npar=npar))
             timeFFT+=time()-t0
 
         if getCC:
-            uhu=UHU(seedname)
+            uhu=UHU(seedname,cache=cache)
             t0=time()
-            self.CC_R=fourier_q_to_R_loc(chk.get_CC_q(uhu,mmn))
+            self.CC_R=fourier_q_to_R_loc(chk.get_CC_q(uhu,mmn,npar=npar))
             timeFFT+=time()-t0
             del uhu
 
         if getSS:
-            spn=SPN(seedname)
+            spn=SPN(seedname,cache=cache)
             t0=time()
             self.SS_R=fourier_q_to_R_loc(chk.get_SS_q(spn))
             timeFFT+=time()-t0
             del spn
         if getSA:
-            siu=SIU(seedname)
+            siu=SIU(seedname,cache=cache)
             t0=time()
-            self.SA_R=fourier_q_to_R_loc(chk.get_SA_q(siu,mmn))
+            self.SA_R=fourier_q_to_R_loc(chk.get_SA_q(siu,mmn,npar=npar))
             timeFFT+=time()-t0
             del siu
         if getSHA:
-            shu=SHU(seedname)
+            shu=SHU(seedname,cache=cache)
             t0=time()
-            self.SHA_R=fourier_q_to_R_loc(chk.get_SHA_q(shu,mmn))
+            self.SHA_R=fourier_q_to_R_loc(chk.get_SHA_q(shu,mmn,npar=npar))
             timeFFT+=time()-t0
             del shu
 
@@ -141,68 +144,85 @@ class System_w90(System):
         if  use_ws:
             print ("using ws_distance")
             ws_map=ws_dist_map_gen(self.iRvec,chk.wannier_centres, chk.mp_grid,self.real_lattice)
-            for X in ['HH','AA','BB','CC','SS','FF','SA','SHA']:
-                XR=X+'_R'
-                if vars(self)[XR] is not None:
-                    print ("using ws_dist for {}".format(XR))
-                    vars(self)[XR]=ws_map(vars(self)[XR])
+            XR=[X+'_R' for X in ['HH','AA','BB','CC','SS','FF','SA','SHA'] if vars(self)[X+'_R'] is not None]
+            print ("using ws_dist for {}".format(", ".join(XR)))
+            # one by one, so that each input is released as soon as it is mapped
+            for X in XR:
+                vars(self)[X]=ws_map(vars(self)[X])
             self.iRvec=np.array(ws_map._iRvec_ordered,dtype=int)
 
+        # now cast the computed matrices
+        self.set_precision(precision)
+
         print ("Number of wannier functions:",self.num_wann)
         print ("Number of R points:", self.nRvec)
         print ("Minimal Number of K points:", self.NKFFTmin)
         print ("Real-space lattice:\n",self.real_lattice)
 
     def wigner_seitz(self,mp_grid):
-        real_metric=self.real_lattice.T.dot(self.real_lattice)
-        mp_grid=np.array(mp_grid)
-        irvec=[]
-        ndegen=[]
-        for n in iterate3dpm(mp_grid):
-            # Loop over the 125 points R. R=0 corresponds to i1=i2=i3=0,
-            # or icnt=63  (62 starting from zero)
-            dist=[]
-            for i in iterate3dpm((2,2,2)):
-                ndiff=n-i*mp_grid
-                dist.append(ndiff.dot(real_metric.dot(ndiff)))
-            dist_min = np.min(dist)
-            if  abs(dist[62] - dist_min) < 1.e-7 :
-                irvec.append(n)
-                ndegen.append(np.sum( abs(dist - dist_min) < 1.e-7 ))
-    
-        return np.array(irvec),np.array(ndegen)
+        irvec,ndegen=wigner_seitz(tuple(int(n) for n in mp_grid),tuple(self.real_lattice.reshape(-1)))
+        return irvec.copy(),ndegen.copy()
+
+
+@functools.lru_cache(maxsize=16)
+def wigner_seitz(mp_grid,real_lattice,chunk=2**14):
+    """ the R-vectors of the Wigner-Seitz supercell of mp_grid and their degeneracies, in the 
+        order of iterate3dpm(mp_grid). The distances to all 125 supercell images are evaluated
+        for chunks of points at once. The result is memoized, 
+        hence mp_grid and real_lattice (flattened) should be given as tuples"""
+    real_lattice=np.array(real_lattice).reshape(3,3)
+    real_metric=real_lattice.T.dot(real_lattice)
+    mp_grid=np.array(mp_grid)
+    grid3d=lambda size : np.array(np.meshgrid(*[np.arange(-s,s+1) for s in size],indexing='ij')).reshape(3,-1).T
+    # the 125 images. i=0 corresponds to icnt=62 (starting from zero)
+    shifts=grid3d((2,2,2))*mp_grid[None,:]
+    irvec=[]
+    ndegen=[]
+    for n in np.array_split(grid3d(mp_grid),max(1,np.prod(2*mp_grid+1)//chunk)):
+        ndiff=n[:,None,:]-shifts[None,:,:]
+        dist=np.einsum('nia,ab,nib->ni',ndiff,real_metric,ndiff)
+        dist_min=dist.min(axis=1)
+        select=abs(dist[:,62] - dist_min) < 1.e-7
+        irvec.append(n[select])
+        ndegen.append(np.sum( abs(dist[select] - dist_min[select,None]) < 1.e-7 ,axis=1))
+    return np.concatenate(irvec),np.concatenate(ndegen)
 
 
 class ws_dist_map_gen(ws_dist_map):
 
-    def __init__(self,iRvec,wannier_centres, mp_grid,real_lattice):
+    def __init__(self,iRvec,wannier_centres, mp_grid,real_lattice,chunk_bytes=2**27):
     ## Find the supercell translation (i.e. the translation by a integer number of
     ## supercell vectors, the supercell being defined by the mp_grid) that
     ## minimizes the distance between two given Wannier functions, i and j,
     ## the first in unit cell 0, the other in unit cell R.
     ## I.e., we find the translation to put WF j in the Wigner-Seitz of WF i.
     ## We also look for the number of equivalent translation, that happen when w_j,R
-    ## is on the edge of the WS of w_i,0. The results are stored 
-    ## a dictionary shifts_iR[(iR,i,j)]
+    ## is on the edge of the WS of w_i,0. 
+    ## The search is done for all (R,i,j) and shifts at once, in chunks of pairs (R,i) 
+    ## taking about `chunk_bytes` of memory, and the results go directly to the sparse map
         ws_search_size=np.array([2]*3)
         ws_distance_tol=1e-5
         cRvec=iRvec.dot(real_lattice)
         mp_grid=np.array(mp_grid)
         shifts_int_all= np.array([ijk  for ijk in iterate3dpm(ws_search_size+1)])*np.array(mp_grid[None,:])
+        shifts_cart_all=shifts_int_all.dot(real_lattice)
         self.num_wann=wannier_centres.shape[0]
-        self._iRvec_new=dict()
-
-        for ir,iR in enumerate(iRvec):
-          for jw in range(self.num_wann):
-            for iw in range(self.num_wann):
-              # function JW translated in the Wigner-Seitz around function IW
-              # and also find its degeneracy, and the integer shifts needed
-              # to identify it
-              R_in=-wannier_centres[iw] +cRvec[ir] + wannier_centres[ jw]
-              dist=np.linalg.norm( R_in[None,:]+shifts_int_all.dot(real_lattice),axis=1)
-              irvec_new=iR+shifts_int_all[ dist-dist.min() < ws_distance_tol ].copy()
-              self._add_star(ir,irvec_new,iw,jw)
-        self._init_end(iRvec.shape[0])
+        # function JW translated in the Wigner-Seitz around function IW : [iw,jw]
+        wc_diff=wannier_centres[None,:,:]-wannier_centres[:,None,:]
+        # chunks over the flattened index (ir,iw), so that the memory is bounded also for large num_wann
+        npair=iRvec.shape[0]*self.num_wann
+        nchunk=max(1,chunk_bytes//(8*4*self.num_wann*shifts_int_all.shape[0]))
+        contrib=[]
+        for ip0 in range(0,npair,nchunk):
+            ir_p,iw_p=np.divmod(np.arange(ip0,min(ip0+nchunk,npair)),self.num_wann)
+            R_in=cRvec[ir_p,None,:]+wc_diff[iw_p]
+            dist=np.linalg.norm( R_in[:,:,None,:]+shifts_cart_all[None,None,:,:],axis=-1)
+            select=dist-dist.min(axis=-1)[:,:,None] < ws_distance_tol
+            ip,jw,ishift=np.nonzero(select)
+            weight=1./select.sum(axis=-1)[ip,jw]
+            ir=ir_p[ip]
+            contrib.append( (ir,iRvec[ir]+shifts_int_all[ishift],iw_p[ip],jw,weight) )
+        self._init_sparse(iRvec.shape[0],*(np.concatenate(x) for x in zip(*contrib)))
 
 
 
@@ -14,11 +14,18 @@
 
 import numpy as np
 from scipy.io import FortranFile 
+from itertools import islice
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import tempfile
 import copy
 import lazy_property
 import functools
 #import billiard as multiprocessing 
 import multiprocessing 
+from multiprocessing.pool import ThreadPool
 from .__utility import str2bool, alpha_A, beta_A, iterate3dpm
 from colorama import init
 from termcolor import cprint 
@@ -26,6 +33,82 @@ from termcolor import cprint
 
 readstr  = lambda F : "".join(c.decode('ascii')  for c in F.read_record('c') ).strip() 
 
+# the overlaps are processed in chunks of k-points taking about this amount of memory (bytes)
+K_CHUNK_BYTES=2**26
+
+# version of the binary cache layout. Increase it whenever the arrays stored by the readers change
+CACHE_VERSION=1
+CACHE_SUFFIX=".wbcache"
+
+def _cache_stamp(filename):
+    "identifies the state of the source file, the cache is valid only if the stamp matches"
+    st=os.stat(filename)
+    return "{} {} {}".format(CACHE_VERSION,st.st_size,st.st_mtime_ns)
+
+
+# maximal number of lines of a formatted file converted in one call, bounds the temporary text buffer
+FORMATTED_CHUNK=2**16
+
+def read_formatted(f,nlines,ncol,out=None):
+    """ reads `nlines` lines with `ncol` numbers each from the opened text file `f`.
+        The text is converted in chunks of FORMATTED_CHUNK lines straight into `out`
+        (a preallocated contiguous float array of nlines*ncol elements, created if not given)
+        nlines=None  - read until the end of the file  """
+    if nlines is None:
+        chunks=[]
+        while True:
+            a=np.fromstring("".join(islice(f,FORMATTED_CHUNK)),sep=" ")
+            if a.shape[0]==0:
+                break
+            chunks.append(a)
+        a=np.concatenate(chunks) if len(chunks)>0 else np.zeros(0)
+        if a.shape[0]%ncol!=0:
+            raise RuntimeError("the number of values in file {} is not a multiple of {}".format(f.name,ncol))
+        return a.reshape(-1,ncol)
+    if out is None:
+        out=np.empty( (nlines,ncol) )
+    flat=out.reshape(-1)
+    assert flat.shape[0]==nlines*ncol and np.may_share_memory(flat,out)
+    for start in range(0,nlines,FORMATTED_CHUNK):
+        n=min(FORMATTED_CHUNK,nlines-start)
+        a=np.fromstring("".join(islice(f,n)),sep=" ")
+        if a.shape[0]!=n*ncol:
+            raise RuntimeError("unexpected end or format of file {} : expected {} numbers, found {}".format(f.name,n*ncol,a.shape[0]))
+        flat[start*ncol:(start+n)*ncol]=a
+    return out
+
+
+def read_formatted_complex(f,num,out=None):
+    """ reads `num` complex numbers, one per line  (real and imaginary parts) into a
+        contiguous complex array `out` of `num` elements (created if not given) """
+    if out is None:
+        out=np.empty(num,dtype=complex)
+    read_formatted(f,num,2,out=out.reshape(-1).view(float))
+    return out
+
+
+def fortran_record_offsets(filename):
+    """ one pass over the markers of a sequential unformatted Fortran file (4-byte markers),
+        without reading the data. Returns the positions (in bytes) of the data of each record 
+        and the record lengths. Raises ValueError if the markers are inconsistent """
+    size=os.path.getsize(filename)
+    offsets=[]
+    lengths=[]
+    with open(filename,"rb") as f:
+        pos=0
+        while pos<size:
+            f.seek(pos)
+            head,=struct.unpack("=I",f.read(4))
+            f.seek(pos+4+head)
+            tail=f.read(4)
+            if len(tail)<4 or struct.unpack("=I",tail)[0]!=head:
+                raise ValueError("inconsistent record markers in file {} at position {}".format(filename,pos))
+            offsets.append(pos+4)
+            lengths.append(head)
+            pos+=8+head
+    return np.array(offsets,dtype=int),np.array(lengths,dtype=int)
+
+
 class CheckPoint():
 
     def __init__(self,seedname):
@@ -75,97 +158,102 @@ class CheckPoint():
             self.v_matrix=[u  for u in u_matrix ] 
         self.wannier_centres=readfloat().reshape((self.num_wann,3))
         self.wannier_spreads=readfloat().reshape((self.num_wann))
+        # v_matrix padded with zeros outside the windows, to rotate many k-points at once
+        self.v_matrix_pad=np.zeros( (self.num_kpts,self.num_wann,self.num_bands),dtype=complex)
+        for ik,v in enumerate(self.v_matrix):
+            self.v_matrix_pad[ik,:,self.win_min[ik]:self.win_max[ik]]=v
 
     def wannier_gauge(self,mat,ik1,ik2):
         # data should be of form NBxNBx ...   - any form later
         if len(mat.shape)==1:
             mat=np.diag(mat)
-        assert mat.shape[:2]==(self.num_bands,)*2
-        shape=mat.shape[2:]
-        mat=mat.reshape(mat.shape[:2]+(-1,)).transpose(2,0,1)
-        mat=mat[:,self.win_min[ik1]:self.win_max[ik1],self.win_min[ik2]:self.win_max[ik2]]
-        v1=self.v_matrix[ik1].conj()
-        v2=self.v_matrix[ik2].T
-        return np.array( [v1.dot(m).dot(v2) for m in mat]).transpose( (1,2,0) ).reshape( (self.num_wann,)*2+shape )
+        return self.wannier_gauge_batch(mat[None],[ik1],[ik2])[0]
+
+    def wannier_gauge_batch(self,mat,ik1,ik2):
+        """ rotates a stack of matrices to the Wannier gauge at once.
+            mat[i] of form NBxNBx ... is between the k-points ik1[i] and ik2[i]
+            mat of form  N x NB  means a stack of diagonal matrices 
+            returns an array N x num_wann x num_wann x ... """
+        v1=self.v_matrix_pad[np.asarray(ik1)].conj()
+        v2=self.v_matrix_pad[np.asarray(ik2)].transpose(0,2,1)
+        if mat.ndim==2:
+            return np.matmul(v1*mat[:,None,:],v2)
+        assert mat.shape[1:3]==(self.num_bands,)*2
+        shape=mat.shape[3:]
+        mat=mat.reshape(mat.shape[:3]+(-1,)).transpose(0,3,1,2)
+        res=np.matmul(np.matmul(v1[:,None],mat),v2[:,None])
+        return res.transpose( (0,2,3,1) ).reshape( (mat.shape[0],)+(self.num_wann,)*2+shape )
 
 
     def get_HH_q(self,eig):
         assert (eig.NK,eig.NB)==(self.num_kpts,self.num_bands)
-        HH_q=np.array([ self.wannier_gauge(E,ik,ik)  for ik,E in enumerate(eig.data) ]) 
+        HH_q=self.wannier_gauge_batch(eig.data,range(self.num_kpts),range(self.num_kpts))
         return 0.5*(HH_q+HH_q.transpose(0,2,1).conj())
 
 
     def get_SS_q(self,spn):
         assert (spn.NK,spn.NB)==(self.num_kpts,self.num_bands)
-        SS_q=np.array([ self.wannier_gauge(S,ik,ik)  for ik,S in enumerate(spn.data) ]) 
+        SS_q=self.wannier_gauge_batch(spn.data,range(self.num_kpts),range(self.num_kpts))
         return 0.5*(SS_q+SS_q.transpose(0,2,1,3).conj())
 
-    def get_AA_q(self,mmn,eig=None,transl_inv=False):  # if eig is present - it is BB_q 
+    def get_AA_q(self,mmn,eig=None,transl_inv=False,npar=1):  # if eig is present - it is BB_q 
         if transl_inv and (eig is not None):
             raise RuntimeError("transl_inv cannot be used to obtain BB")
         mmn.set_bk(self)
         AA_q=np.zeros( (self.num_kpts,self.num_wann,self.num_wann,3) ,dtype=complex)
-        for ik in range(self.num_kpts):
-            for ib in range(mmn.NNB):
-                iknb=mmn.neighbours[ik,ib]
-                data=mmn.data[ik,ib]
-                if eig is not None:
-                    data*=eig.data[ik,:,None]
-                AAW=self.wannier_gauge(data,ik,iknb)
-                AA_q_ik=1.j*AAW[:,:,None]*mmn.wk[ik,ib]*mmn.bk_cart[ik,ib,None,None,:]
-                if transl_inv:
-                    AA_q_ik[range(self.num_wann),range(self.num_wann)]=-np.log(AAW.diagonal()).imag[:,None]*mmn.wk[ik,ib]*mmn.bk_cart[ik,ib,None,:]
-                AA_q[ik]+=AA_q_ik
+        def fun(iks,mmn_k):
+            nk=len(iks)
+            if eig is not None:
+                mmn_k*=eig.data[iks,None,:,None]
+            AAW=self.wannier_gauge_batch(mmn_k.reshape( (-1,)+mmn_k.shape[2:] ),np.repeat(iks,mmn.NNB),mmn.neighbours[iks].reshape(-1)
+                                   ).reshape(nk,mmn.NNB,self.num_wann**2)
+            wb=mmn.wk[iks,:,None]*mmn.bk_cart[iks]
+            AA_q_k=1.j*np.matmul(AAW.transpose(0,2,1),wb).reshape(nk,self.num_wann,self.num_wann,3)
+            if transl_inv:
+                AAW_diag=AAW.reshape(nk,mmn.NNB,self.num_wann,self.num_wann).diagonal(axis1=2,axis2=3)
+                AA_q_k[:,range(self.num_wann),range(self.num_wann)]=-np.matmul(np.log(AAW_diag).imag.transpose(0,2,1),wb)
+            AA_q[iks]=AA_q_k
+        mmn.map_k(fun,npar=npar,prefetch=False)
         if eig is None:
             AA_q=0.5*(AA_q+AA_q.transpose( (0,2,1,3) ).conj())
         return AA_q
 
-    def get_CC_q(self,uhu,mmn):  # if eig is present - it is BB_q 
+    def get_CC_q(self,uhu,mmn,npar=1):  # if eig is present - it is BB_q 
         mmn.set_bk(self)
         assert uhu.NNB==mmn.NNB
+        NNB=mmn.NNB
         CC_q=np.zeros( (self.num_kpts,self.num_wann,self.num_wann,3) ,dtype=complex)
-        for ik in range(self.num_kpts):
-          for ib1 in range(mmn.NNB):
-            iknb1=mmn.neighbours[ik,ib1]
-            for ib2 in range(mmn.NNB):
-              iknb2=mmn.neighbours[ik,ib2]
-              data=uhu.data[ik,ib1,ib2]
-              CC_q[ik]+=1.j*self.wannier_gauge(data,iknb1,iknb2)[:,:,None]* (
-                   mmn.wk[ik,ib1]*mmn.wk[ik,ib2]* (
-               mmn.bk_cart[ik,ib1,alpha_A]* mmn.bk_cart[ik,ib2,beta_A ] - 
-               mmn.bk_cart[ik,ib1,beta_A] * mmn.bk_cart[ik,ib2,alpha_A]  )  )[None,None,:]
+        def fun(iks,uhu_k):
+            nk=len(iks)
+            nbrs=mmn.neighbours[iks]
+            CCW=self.wannier_gauge_batch(uhu_k.reshape( (-1,)+uhu_k.shape[3:] ),np.repeat(nbrs,NNB,axis=1).reshape(-1),np.tile(nbrs,(1,NNB)).reshape(-1)
+                                   ).reshape(nk,NNB*NNB,self.num_wann**2)
+            wb=mmn.wk[iks,:,None]*mmn.bk_cart[iks]
+            weight=(wb[:,:,None,alpha_A]*wb[:,None,:,beta_A]-wb[:,:,None,beta_A]*wb[:,None,:,alpha_A]).reshape(nk,NNB*NNB,3)
+            CC_q[iks]=1.j*np.matmul(CCW.transpose(0,2,1),weight).reshape(nk,self.num_wann,self.num_wann,3)
+        uhu.map_k(fun,npar=npar)
         CC_q=0.5*(CC_q+CC_q.transpose( (0,2,1,3) ).conj())
         return CC_q
 
-    def get_SA_q(self,siu,mmn):
-        mmn.set_bk(self)
-        SA_q=np.zeros( (self.num_kpts,self.num_wann,self.num_wann,3,3) ,dtype=complex)
-        assert siu.NNB==mmn.NNB
-        for ik in range(self.num_kpts):
-            for ib in range(mmn.NNB):
-                iknb=mmn.neighbours[ik,ib]
-                for ipol in range(3):
-                    data=siu.data[ik,ib,ipol]
-                    SAW=self.wannier_gauge(data,ik,iknb)
-                    SA_q_ik=1.j*SAW[:,:,None]*mmn.wk[ik,ib]*mmn.bk_cart[ik,ib,None,None,:]
-                    SA_q[ik,:,:,:,ipol]+=SA_q_ik
-        SA_q=0.5*(SA_q+SA_q.transpose( (0,2,1,3,4) ).conj())
-        return SA_q
-
-    def get_SHA_q(self,shu,mmn):
+    def _get_SXA_q(self,sxu,mmn,npar=1):
+        "common part of get_SA_q and get_SHA_q"
         mmn.set_bk(self)
-        SHA_q=np.zeros( (self.num_kpts,self.num_wann,self.num_wann,3,3) ,dtype=complex)
-        assert shu.NNB==mmn.NNB
-        for ik in range(self.num_kpts):
-            for ib in range(mmn.NNB):
-                iknb=mmn.neighbours[ik,ib]
-                for ipol in range(3):
-                    data=shu.data[ik,ib,ipol]
-                    SHAW=self.wannier_gauge(data,ik,iknb)
-                    SHA_q_ik=1.j*SHAW[:,:,None]*mmn.wk[ik,ib]*mmn.bk_cart[ik,ib,None,None,:]
-                    SHA_q[ik,:,:,:,ipol]+=SHA_q_ik
-        SHA_q=0.5*(SHA_q+SHA_q.transpose( (0,2,1,3,4) ).conj())
-        return SHA_q
+        assert sxu.NNB==mmn.NNB
+        SXA_q=np.zeros( (self.num_kpts,self.num_wann,self.num_wann,3,3) ,dtype=complex)
+        def fun(iks,sxu_k):
+            nk=len(iks)
+            SXAW=self.wannier_gauge_batch(sxu_k.reshape( (-1,)+sxu_k.shape[2:] ).transpose(0,2,3,1),np.repeat(iks,mmn.NNB),mmn.neighbours[iks].reshape(-1)
+                                   ).reshape(nk,mmn.NNB,self.num_wann**2*3)
+            wb=mmn.wk[iks,:,None]*mmn.bk_cart[iks]
+            SXA_q[iks]=1.j*np.matmul(SXAW.transpose(0,2,1),wb).reshape(nk,self.num_wann,self.num_wann,3,3).transpose(0,1,2,4,3)
+        sxu.map_k(fun,npar=npar)
+        return 0.5*(SXA_q+SXA_q.transpose( (0,2,1,3,4) ).conj())
+
+    def get_SA_q(self,siu,mmn,npar=1):
+        return self._get_SXA_q(siu,mmn,npar=npar)
+
+    def get_SHA_q(self,shu,mmn,npar=1):
+        return self._get_SXA_q(shu,mmn,npar=npar)
 
 
 class W90_data():
@@ -173,6 +261,98 @@ class W90_data():
     def n_neighb(self):
         return 0
 
+    def _read_cache(self,filename,names=('data',)):
+        """ tries to take the arrays `names` from the binary cache of `filename`.
+            The arrays are memory-mapped (copy-on-write), so the pages are shared between processes.
+            returns True on success, False if the cache is absent or outdated """
+        cachedir=filename+CACHE_SUFFIX
+        try:
+            with open(os.path.join(cachedir,"stamp"),"r") as f:
+                if f.read().strip()!=_cache_stamp(filename):
+                    return False
+            arrays={name:np.load(os.path.join(cachedir,name+".npy"),mmap_mode='c') for name in names}
+        except (OSError,ValueError):
+            return False
+        for name,a in arrays.items():
+            setattr(self,name,a)
+        print ("reading {} from the cache {}".format(filename,cachedir))
+        return True
+
+    def _write_cache(self,filename,names=('data',)):
+        """ stores the arrays `names` in the binary cache of `filename`. 
+            Failure to write the cache (e.g. read-only directory) is not fatal """
+        cachedir=filename+CACHE_SUFFIX
+        tmpdir=None
+        try:
+            stamp=_cache_stamp(filename)
+            tmpdir=tempfile.mkdtemp(prefix=os.path.basename(cachedir)+".",dir=os.path.dirname(os.path.abspath(filename)))
+            for name in names:
+                np.save(os.path.join(tmpdir,name+".npy"),np.ascontiguousarray(getattr(self,name)))
+            with open(os.path.join(tmpdir,"stamp"),"w") as f:
+                f.write(stamp+"\n")
+            shutil.rmtree(cachedir,ignore_errors=True)
+            os.rename(tmpdir,cachedir)
+        except OSError as err:
+            print ("WARNING: failed to write the cache {} : {}".format(cachedir,err))
+            if tmpdir is not None:
+                shutil.rmtree(tmpdir,ignore_errors=True)
+
+    def _memmap_records(self,filename,nskip,shape,rec_shape):
+        """ maps (read-only, without reading) the complex data records of an unformatted file,
+            following `nskip` header records, as an array of shape `shape+rec_shape`.
+            Slices like data[ik] are then read from the disk only when accessed.
+            Requires the records to be of equal length and stored contiguously, otherwise raises ValueError """
+        offsets,lengths=fortran_record_offsets(filename)
+        offsets,lengths=offsets[nskip:],lengths[nskip:]
+        reclen=16*np.prod(rec_shape)
+        if ( len(offsets)!=np.prod(shape) or np.any(lengths!=reclen) 
+                or np.any(offsets-offsets[0]!=np.arange(len(offsets))*(reclen+8)) ):
+            raise ValueError("the records of {} do not form a regular array of shape {}".format(filename,shape+rec_shape))
+        rec_dtype=np.dtype([('head',np.uint32),('data',np.complex128,rec_shape),('tail',np.uint32)])
+        return np.memmap(filename,dtype=rec_dtype,mode='r',offset=offsets[0]-4,shape=shape)['data']
+
+    def k_chunks(self,chunk_bytes=None,nchunks_min=1):
+        """ splits the k-points into consecutive chunks of about `chunk_bytes` of data 
+            (by default K_CHUNK_BYTES, at least one k-point), but at least `nchunks_min` chunks if possible"""
+        if chunk_bytes is None:
+            chunk_bytes=K_CHUNK_BYTES
+        nk=max(1,min(chunk_bytes//self.data[0].nbytes,-(-self.NK//nchunks_min)))
+        return [np.arange(k0,min(k0+nk,self.NK)) for k0 in range(0,self.NK,nk)]
+
+    def load_k(self,iks):
+        "data of a chunk of consecutive k-points, copied into memory"
+        return np.array(self.data[iks[0]:iks[-1]+1])
+
+    def iter_k(self,prefetch=True,chunk_bytes=None):
+        """ yields (iks, data[iks]) for consecutive chunks of k-points iks (see k_chunks), 
+            with the block copied into memory. So only one (two with prefetch) chunks are resident
+            at a time, even if the data is memory-mapped. With prefetch the next chunk is read 
+            in a background thread while the current one is being processed """
+        chunks=self.k_chunks(chunk_bytes)
+        if not prefetch:
+            for iks in chunks:
+                yield iks,self.load_k(iks)
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future=executor.submit(self.load_k,chunks[0])
+            for i,iks in enumerate(chunks):
+                block=future.result()
+                if i+1<len(chunks):
+                    future=executor.submit(self.load_k,chunks[i+1])
+                yield iks,block
+
+    def map_k(self,fun,npar=1,prefetch=True):
+        """ calls fun(iks,data[iks]) for all chunks of k-points. 
+            With npar>1 the chunks are processed by a pool of npar threads. The numpy kernels
+            release the GIL, and the threads share the inputs (in memory or memory-mapped) 
+            without copying or pickling them. fun should write only to the k-points iks of its output"""
+        if npar>1:
+            with ThreadPool(npar) as pool:
+                pool.map(lambda iks : fun(iks,self.load_k(iks)),self.k_chunks(nchunks_min=npar))
+        else:
+            for iks,block in self.iter_k(prefetch=prefetch):
+                fun(iks,block)
+
     @property 
     def  NK(self):
         return self.data.shape[0]
@@ -196,21 +376,26 @@ class MMN(W90_data):
         return 1
 
 
-    def __init__(self,seedname,num_proc=4):
-        f_mmn_in=open(seedname+".mmn","r").readlines()
-        print ("reading {}.mmn: ".format(seedname)+f_mmn_in[0])
-        s=f_mmn_in[1]
-        NB,NK,NNB=np.array(s.split(),dtype=int)
+    def __init__(self,seedname,cache=False):
+        if cache and self._read_cache(seedname+".mmn",('data','G','neighbours')):
+            return
+        f_mmn_in=open(seedname+".mmn","r")
+        print ("reading {}.mmn: ".format(seedname)+f_mmn_in.readline())
+        NB,NK,NNB=np.array(f_mmn_in.readline().split(),dtype=int)
         self.data=np.zeros( (NK,NNB,NB,NB), dtype=complex )
-        headstring=np.array([s.split() for s in f_mmn_in[2::1+self.NB**2] ]
-                    ,dtype=int).reshape(self.NK,self.NNB,5)
+        headstring=np.zeros( (NK,NNB,5), dtype=int )
+        block=np.zeros( (NB,NB), dtype=complex )
+        for ik in range(NK):
+            for ib in range(NNB):
+                headstring[ik,ib]=f_mmn_in.readline().split()
+                read_formatted_complex(f_mmn_in,NB*NB,out=block)
+                self.data[ik,ib]=block.T
+        f_mmn_in.close()
         self.G=headstring[:,:,2:]
         self.neighbours=headstring[:,:,1]-1
         assert np.all( headstring[:,:,0]-1==np.arange(self.NK)[:,None])
-        block=1+self.NB*self.NB
-        allmmn=( f_mmn_in[3+j*block:2+(j+1)*block]  for j in range(self.NNB*self.NK) )
-        p=multiprocessing.Pool(num_proc)
-        self.data= np.array(p.map(str2arraymmn,allmmn)).reshape(self.NK,self.NNB,self.NB,self.NB).transpose((0,1,3,2))
+        if cache:
+            self._write_cache(seedname+".mmn",('data','G','neighbours'))
 
     def set_bk(self,chk):
       try :
@@ -242,27 +427,27 @@ class MMN(W90_data):
         
 
 
-def str2arraymmn(A):
-    a=np.array([l.split() for l in A],dtype=float)
-    n=int(round(np.sqrt(a.shape[0])))
-    return (a[:,0]+1j*a[:,1]).reshape((n,n))
-
-
-
 class EIG(W90_data):
-    def __init__(self,seedname):
-        data=np.loadtxt(seedname+".eig")
+    def __init__(self,seedname,cache=False):
+        if cache and self._read_cache(seedname+".eig"):
+            return
+        with open(seedname+".eig","r") as f:
+            data=read_formatted(f,None,3)
         NB=int(round(data[:,0].max()))
         NK=int(round(data[:,1].max()))
         data=data.reshape(NK,NB,3)
         assert np.linalg.norm(data[:,:,0]-1-np.arange(NB)[None,:])<1e-15
         assert np.linalg.norm(data[:,:,1]-1-np.arange(NK)[:,None])<1e-15
         self.data=data[:,:,2]
+        if cache:
+            self._write_cache(seedname+".eig")
 
             
 class SPN(W90_data):
-    def __init__(self,seedname='wannier90',formatted=False):
+    def __init__(self,seedname='wannier90',formatted=False,cache=False):
         print ("----------\n SPN  \n---------\n")
+        if cache and self._read_cache(seedname+".spn"):
+            return
         spn_formatted_in=formatted
         if  spn_formatted_in:
             f_spn_in = open(seedname+".spn", 'r')
@@ -282,8 +467,7 @@ class SPN(W90_data):
         for ik in range(NK):
             A=np.zeros((3,nbnd,nbnd),dtype=np.complex)
             if spn_formatted_in:
-                tmp=np.array( [f_spn_in.readline().split() for i in xrange (3*nbnd*(nbnd+1)/2)  ],dtype=float)
-                tmp=tmp[:,0]+1.j*tmp[:,1]
+                tmp=read_formatted_complex(f_spn_in,3*nbnd*(nbnd+1)//2)
             else:
                 tmp=f_spn_in.read_record(dtype=np.complex)
             A[:,indn,indm]=tmp.reshape(3,nbnd*(nbnd+1)//2,order='F')
@@ -292,6 +476,9 @@ class SPN(W90_data):
             if check> 1e-10:
                 raise RuntimeError ( "REAL DIAG CHECK FAILED : {0}".format(check) )
             self.data[ik]=A.transpose(1,2,0)
+        f_spn_in.close()
+        if cache:
+            self._write_cache(seedname+".spn")
         print ("----------\n SPN OK  \n---------\n")
 
 
@@ -300,8 +487,10 @@ class UXU(W90_data):  # uHu or uIu
     def n_neighb(self):
         return 2
 
-    def __init__(self,seedname='wannier90',formatted=False,suffix='uHu'):
+    def __init__(self,seedname='wannier90',formatted=False,suffix='uHu',cache=False,lazy=True):
         print ("----------\n  {0}   \n---------".format(suffix))
+        if cache and (formatted or not lazy) and self._read_cache(seedname+"."+suffix):
+            return
 
         if formatted:
             f_uXu_in = open(seedname+"."+suffix, 'r')
@@ -314,25 +503,46 @@ class UXU(W90_data):  # uHu or uIu
 
         print ("reading {}.{} : <{}>".format(seedname,suffix,header))
 
+        if lazy and not formatted:
+            f_uXu_in.close()
+            try:
+                # the records are ordered as  ik,ib2,ib1
+                self.data=self._memmap_records(seedname+"."+suffix,2,(NK,NNB,NNB),(NB,NB)).transpose(0,2,1,3,4)
+                print ("----------\n {0} mapped  \n---------\n".format(suffix))
+                return
+            except ValueError as err:
+                print ("cannot map {}.{} ({}), reading it into memory".format(seedname,suffix,err))
+                f_uXu_in = FortranFile(seedname+"."+suffix, 'r')
+                f_uXu_in.read_record('c')
+                f_uXu_in.read_record('i4')
+
         self.data=np.zeros( (NK,NNB,NNB,NB,NB),dtype=complex )
 
+        if formatted:
+            tmp=np.zeros( (NNB,NNB,NB,NB),dtype=complex )
         for ik in range(NK):
 #            print ("k-point {} of {}".format( ik+1,NK))
+            if formatted:
+                read_formatted_complex(f_uXu_in,NNB*NNB*NB*NB,out=tmp)
+                self.data[ik]=tmp.transpose(1,0,2,3)
+                continue
             for ib2 in range(NNB):
                 for ib1 in range(NNB):
                     tmp=f_uXu_in.read_record('f8').reshape((2,NB,NB),order='F').transpose(2,1,0) 
                     self.data[ik,ib1,ib2]=tmp[:,:,0]+1j*tmp[:,:,1]
-        print ("----------\n {0} OK  \n---------\n".format(suffix))
         f_uXu_in.close()
+        if cache:
+            self._write_cache(seedname+"."+suffix)
+        print ("----------\n {0} OK  \n---------\n".format(suffix))
 
 
 class UHU(UXU):  
-    def __init__(self,seedname='wannier90',formatted=False):
-        super(UHU, self).__init__(seedname=seedname,formatted=formatted,suffix='uHu' )
+    def __init__(self,seedname='wannier90',formatted=False,cache=False,lazy=True):
+        super(UHU, self).__init__(seedname=seedname,formatted=formatted,suffix='uHu',cache=cache,lazy=lazy )
 
 class UIU(UXU):  
-    def __init__(self,seedname='wannier90',formatted=False):
-        super(UIU, self).__init__(seedname=seedname,formatted=formatted,suffix='uIu' )
+    def __init__(self,seedname='wannier90',formatted=False,cache=False,lazy=True):
+        super(UIU, self).__init__(seedname=seedname,formatted=formatted,suffix='uIu',cache=cache,lazy=lazy )
 
 
 class SXU(W90_data):  # sHu or sIu
@@ -340,8 +550,10 @@ class SXU(W90_data):  # sHu or sIu
     def n_neighb(self):
         return 1
 
-    def __init__(self,seedname='wannier90',formatted=False,suffix='sHu'):
+    def __init__(self,seedname='wannier90',formatted=False,suffix='sHu',cache=False,lazy=True):
         print ("----------\n  {0}   \n---------".format(suffix))
+        if cache and (formatted or not lazy) and self._read_cache(seedname+"."+suffix):
+            return
 
         if formatted:
             f_sXu_in = open(seedname+"."+suffix, 'r')
@@ -354,23 +566,40 @@ class SXU(W90_data):  # sHu or sIu
 
         print ("reading {}.{} : <{}>".format(seedname,suffix,header))
 
+        if lazy and not formatted:
+            f_sXu_in.close()
+            try:
+                self.data=self._memmap_records(seedname+"."+suffix,2,(NK,NNB,3),(NB,NB))
+                print ("----------\n {0} mapped  \n---------\n".format(suffix))
+                return
+            except ValueError as err:
+                print ("cannot map {}.{} ({}), reading it into memory".format(seedname,suffix,err))
+                f_sXu_in = FortranFile(seedname+"."+suffix, 'r')
+                f_sXu_in.read_record('c')
+                f_sXu_in.read_record('i4')
+
         self.data=np.zeros( (NK,NNB,3,NB,NB),dtype=complex )
 
         for ik in range(NK):
 #            print ("k-point {} of {}".format( ik+1,NK))
+            if formatted:
+                read_formatted_complex(f_sXu_in,NNB*3*NB*NB,out=self.data[ik])
+                continue
             for ib2 in range(NNB):
                 for ipol in range(3):
                    tmp=f_sXu_in.read_record('f8').reshape((2,NB,NB),order='F').transpose(2,1,0) 
                    self.data[ik,ib2,ipol]=tmp[:,:,0]+1j*tmp[:,:,1]
-        print ("----------\n {0} OK  \n---------\n".format(suffix))
         f_sXu_in.close()
+        if cache:
+            self._write_cache(seedname+"."+suffix)
+        print ("----------\n {0} OK  \n---------\n".format(suffix))
 
 
 class SIU(SXU):
-    def __init__(self,seedname='wannier90',formatted=False):
-        super(SIU, self).__init__(seedname=seedname,formatted=formatted,suffix='sIu' )
+    def __init__(self,seedname='wannier90',formatted=False,cache=False,lazy=True):
+        super(SIU, self).__init__(seedname=seedname,formatted=formatted,suffix='sIu',cache=cache,lazy=lazy )
 
 class SHU(SXU):
-    def __init__(self,seedname='wannier90',formatted=False):
-        super(SHU, self).__init__(seedname=seedname,formatted=formatted,suffix='sHu' )
+    def __init__(self,seedname='wannier90',formatted=False,cache=False,lazy=True):
+        super(SHU, self).__init__(seedname=seedname,formatted=formatted,suffix='sHu',cache=cache,lazy=lazy )
 